@@ -0,0 +1,296 @@
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import shutil
+import tempfile
+import threading
+import contextlib
+from urllib import parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import metrics
+import utility
+import bilibili
+import manifest
+import download as downloader
+
+logger = utility.log('bench')
+
+# the shape of the emulated bilibili, tunable by the command line options, e.g. -v:500
+options = dict(m=2, v=300, d=1, f=2048, l=20, b=0, a=200, gzip=1, io=256)
+option_names = dict(m='channels', v='videos per channel', d='durl segments per video', f='file size in KB',
+                    l='cdn latency in ms', b='cdn bandwidth per connection in KB/s (0 unlimited)',
+                    a='video page size in KB', gzip='gzip the video pages (0/1)',
+                    io='MB written by the disk write benchmark (0 skips it)')
+
+
+class MockBilibili(ThreadingHTTPServer):
+    # one local server answering getSubmitVideos, av<aid> pages, the kanbilibili durl api and the cdn
+    daemon_threads = True
+
+    def __init__(self, channels, videos, segments, file_size, latency, bandwidth, page_size, gzipped):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), MockHandler)
+        self.base = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.mids = [str(30000000 + i) for i in range(channels)]
+        self.videos = videos
+        self.segments = segments
+        self.latency = latency / 1000.0
+        self.bandwidth = bandwidth * 1024
+        self.gzipped = gzipped
+        self.file = bytes(range(256)) * (file_size * 1024 // 256)
+        head = b'<html><head>' + b'<meta name="x">' * 1000 + b'</head><body>'
+        self.page = (head, b'<p>padding</p>' * (page_size * 1024 // 14) + b'</body></html>')
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def count(self, name, size):
+        with self.lock:
+            requests, sent = self.counters.get(name, (0, 0))
+            self.counters[name] = (requests + 1, sent + size)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+
+    def aids(self, mid):
+        base = int(mid) * 100000
+        return [base + i for i in range(self.videos, 0, -1)]  # newest first, like order=pubdate
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def reply(self, name, body, content_type='application/json', status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(name, len(body))
+
+    def do_GET(self):
+        url = parse.urlsplit(self.path)
+        query = dict(parse.parse_qsl(url.query))
+        try:
+            if url.path == '/ajax/member/getSubmitVideos':
+                self.submit_videos(query)
+            elif url.path.startswith('/video/av'):
+                self.video_page(int(url.path[len('/video/av'):]))
+            elif url.path.startswith('/api/video/'):
+                self.durl(int(url.path.split('/')[3]), query['cid'])
+            elif url.path.startswith('/cdn/'):
+                self.cdn()
+            else:
+                self.reply('unknown', b'not found', 'text/plain', 404)
+        except (ConnectionError, BrokenPipeError):
+            pass
+
+    def submit_videos(self, query):
+        aids = self.server.aids(query['mid'])
+        size = int(query['pagesize'])
+        page = int(query['page'])
+        vlist = [dict(aid=aid, title='video {}'.format(aid)) for aid in aids[(page - 1) * size: page * size]]
+        data = dict(status=True, data=dict(vlist=vlist, count=len(aids), pages=(len(aids) + size - 1) // size))
+        self.reply('pages', json.dumps(data).encode('utf-8'))
+
+    def video_page(self, aid):
+        head, tail = self.server.page
+        state = 'window.__INITIAL_STATE__={{"aid":{},"videoData":{{"cid":{},"title":"video"}}}};'.format(aid, aid + 7)
+        body = head + '<script>{}</script>'.format(state).encode('utf-8') + tail
+        headers = {}
+        if self.server.gzipped and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 6)
+            headers['Content-Encoding'] = 'gzip'
+        self.reply('cids', body, 'text/html', headers=headers)
+
+    def durl(self, aid, cid):
+        durl = [dict(url='{}/cdn/{}-{}.flv'.format(self.server.base, aid, i)) for i in range(self.server.segments)]
+        self.reply('durls', json.dumps(dict(data=dict(result='ok', durl=durl))).encode('utf-8'))
+
+    def cdn(self):
+        time.sleep(self.server.latency)
+        data = self.server.file
+        start, end, status = 0, len(data) - 1, 200
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/x-flv')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end + 1 - start))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        self.end_headers()
+        view = memoryview(data)[start:end + 1]
+        block = 64 * 1024
+        began = time.monotonic()
+        for offset in range(0, len(view), block):
+            self.wfile.write(view[offset:offset + block])
+            if self.server.bandwidth > 0:
+                ahead = (offset + block) / self.server.bandwidth - (time.monotonic() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.server.count('cdn', len(view))
+
+
+class MemoryResponse:
+    # a response body of size bytes repeating data, the write path is measured without the network
+    def __init__(self, data, size):
+        self.view = memoryview(data)
+        self.size = size
+        self.position = 0
+        self.status = 200
+
+    def getheader(self, name, default=None):
+        return default
+
+    def read(self, amt):
+        amt = min(amt, self.size - self.position, len(self.view) - self.position % len(self.view))
+        offset = self.position % len(self.view)
+        self.position += amt
+        return bytes(self.view[offset:offset + amt])
+
+    def readinto(self, b):
+        amt = min(len(b), self.size - self.position, len(self.view) - self.position % len(self.view))
+        offset = self.position % len(self.view)
+        b[:amt] = self.view[offset:offset + amt]
+        self.position += amt
+        return amt
+
+    def close(self):
+        pass
+
+
+def write_appended(res, fn):
+    # the write loop before the tuned path, a new bytes object of 16 KB per read written to a growing file.
+    # hashed for the manifest like the tuned path, so the two differ by the way they write only
+    digest = manifest.new_hash()
+    with open(fn, 'wb') as f:
+        while True:
+            data = res.read(16 * 1024)
+            if not data:
+                break
+            f.write(data)
+            digest.update(data)
+
+
+def write_in_place(res, fn):
+    # the write path of download.py, one segment into the preallocated file
+    state = dict(length=res.size, segments=[[0, res.size - 1, False]])
+    downloader.download_segments('memory', fn, fn + '.segments', state, res)
+
+
+def run_writes(size):
+    # MB/s of writing size MB through the old loop and through download.py with a few block sizes
+    data = os.urandom(4 * 1024 * 1024)
+    block_size, sync_size = downloader.block_size, downloader.sync_size
+    runs = [('16 KB read/write', write_appended, 16, 0)]
+    if hasattr(os, 'pwrite'):
+        runs += [('readinto 16 KB', write_in_place, 16, 0), ('readinto 256 KB', write_in_place, 256, 0),
+                 ('readinto 1 MB', write_in_place, 1024, 0), ('readinto 1 MB sync 64 MB', write_in_place, 1024, 64)]
+    results = []
+    folder = tempfile.mkdtemp(prefix='bilibili_bench_')
+    try:
+        for name, write, block, sync in runs:
+            downloader.block_size, downloader.sync_size = block * 1024, sync * 1024 * 1024
+            fn = os.path.join(folder, 'write.flv')
+            began = time.perf_counter()
+            write(MemoryResponse(data, size * 1024 * 1024), fn)
+            wall = time.perf_counter() - began
+            os.remove(fn)
+            results.append(dict(path=name, wall=wall, mb_rate=size / wall))
+    finally:
+        downloader.block_size, downloader.sync_size = block_size, sync_size
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def parse_command_line():
+    for arg in sys.argv[1:]:
+        parts = arg.strip().lstrip('-').split(':')
+        key = parts[0].lower()
+        if len(parts) == 2 and key in options:
+            options[key] = int(parts[1])
+        elif len(parts) == 2 and key in bilibili.setting_options:
+            bilibili.settings[bilibili.setting_options[key]] = max(1, int(parts[1]))
+        else:
+            print('not supported option {}'.format(arg))
+            print('options (default):')
+            for k, v in options.items():
+                print('  -{}:n  {} ({})'.format(k, option_names[k], v))
+            print('  and the tuning options of bilibili.py, e.g. -p:n -c:n -s:n -g:n -r:n')
+            return False
+    return True
+
+
+def run_pipeline(server, mode, parameters):
+    server.reset()
+    began = time.monotonic()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        bilibili.run(mode, None, parameters)
+    wall = time.monotonic() - began
+    counters = dict(server.counters)
+    topics = metrics.summary()['counters'].get('topics', 0)
+    cids = counters.get('cids', (0, 0))[0]
+    transferred = counters.get('cdn', (0, 0))[1]
+    return dict(pipeline=mode, wall=wall, topics=topics, cids=cids, mb=transferred / 1024 / 1024,
+                topics_rate=topics / wall, cids_rate=cids / wall, mb_rate=transferred / 1024 / 1024 / wall)
+
+
+def main():
+    if not parse_command_line():
+        exit(-1)
+    server = MockBilibili(options['m'], options['v'], options['d'], options['f'], options['l'], options['b'],
+                          options['a'], options['gzip'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for host in ['space.bilibili.com', 'www.bilibili.com', 'www.kanbilibili.com']:
+        utility.set_host_override(host, server.base)
+
+    urls = ['https://space.bilibili.com/{}/video'.format(mid) for mid in server.mids]
+    files = [os.path.join(mid, '{}.csv'.format(mid)) for mid in server.mids]
+    print('{} channel(s) x {} video(s) x {} segment(s) of {} KB, cdn latency {} ms, bandwidth {}'.format(
+        options['m'], options['v'], options['d'], options['f'], options['l'],
+        '{} KB/s'.format(options['b']) if options['b'] > 0 else 'unlimited'))
+    print('settings {}'.format(bilibili.settings))
+
+    results = []
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix='bilibili_bench_')
+    try:
+        os.chdir(folder)
+        results.append(run_pipeline(server, 'uo', urls))
+        results.append(run_pipeline(server, 'od', files))
+        for mid in server.mids:
+            shutil.rmtree(mid)
+        bilibili.settings['cache_invalidate'] = 'all'  # the cids of uod come from the network again
+        results.append(run_pipeline(server, 'uod', urls))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+        server.shutdown()
+
+    print('{:<9}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}'.format('pipeline', 'wall(s)', 'topics', 'topics/s', 'cids/s',
+                                                             'MB', 'MB/s'))
+    for r in results:
+        print('{pipeline:<9}{wall:>10.2f}{topics:>10}{topics_rate:>12.1f}{cids_rate:>10.1f}{mb:>10.1f}'
+              '{mb_rate:>10.1f}'.format(**r))
+
+    if options['io'] > 0:
+        print()
+        print('{:<28}{:>10}{:>10}'.format('write path ({} MB)'.format(options['io']), 'wall(s)', 'MB/s'))
+        for r in run_writes(options['io']):
+            print('{path:<28}{wall:>10.2f}{mb_rate:>10.1f}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
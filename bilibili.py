@@ -2,17 +2,60 @@ import os
 import re
 import csv
 import sys
+import socket
 import json
-import zlib
-import base64
-import platform
+import time
+import signal
 import threading
 import subprocess
+import itertools
+import contextlib
+import concurrent.futures
+from urllib import parse
 
+import flv
+import jobs
+import cache
+import metrics
 import utility
+import watch
+import manifest
+import workqueue
+import download as downloader
 
 logger = utility.log('bilibili')
 
+# tunable by the command line options, e.g. -p:8
+settings = dict(page_workers=8, cid_workers=8, download_workers=20, segments=1, min_segment_size=4, rate=10,
+                workers=os.cpu_count() or 1, block_size=256, poll_interval=5, progress_rate=4)
+setting_options = dict(p='page_workers', c='cid_workers', s='download_workers', g='segments', z='min_segment_size',
+                       r='rate', w='workers', bs='block_size', poll='poll_interval', pr='progress_rate')
+cid_cache = None  # aid -> cid cache on disk, opened when the application starts
+job_db = None  # the state of the topics and downloads on disk, opened when the application starts
+work_queue = None  # units shared by the coordinator and the worker processes of a -q:file run
+work_keywords = None  # the keywords of the coordinator, used by a worker
+known_topics = {}  # mid -> aids saved in its csv file, loaded once by a worker of an incremental run
+download_engine = None  # thread pool running download.download, created by start_downloads
+durl_engine = None  # thread pool resolving the durls ahead of the downloads, created by start_downloads
+merge_engine = None  # one thread joining the parts of the completed topics with -merge, created by start_downloads
+durl_ttl = 1800  # seconds a durl is trusted when it does not tell its deadline
+durl_margin = 60  # a durl expiring sooner than that is resolved again before it is downloaded
+runid = None  # names the csv file of the failed topics, set when a run starts
+all_files = []
+
+# the scheduler state, topics and downloads are records indexed by status instead of dicts rescanned.
+# the waiting topics have no durls loaded yet, the waiting downloads wait for a free slot
+download_lock = threading.RLock()
+download_done = threading.Event()
+all_topics, all_downloads = jobs.JobStore(), jobs.JobStore()
+loading_topics = 0  # durl resolutions running, of topics and of expired downloads
+download_closed = True  # no more topics to come, set by finish_downloads
+download_stopped = False  # interrupted, nothing more is started, set by stop_downloads
+download_began = None  # when the first download started, for the download phase metrics
+pruned = [0, 0]  # completed downloads and their bytes forgotten by prune_finished
+collected = [0, 0, 0]  # completed and failed downloads and their bytes taken off the queue by collect_downloads
+failed_lock = threading.Lock()
+
 
 def parse_command_line():
     option_mode = 'uo'  # default mode (url->output)
@@ -28,14 +71,37 @@ def parse_command_line():
                 parts = option.split(':')
                 if len(parts) == 1:
                     option = option.lower()
-                    if option in ['uo', 'od', 'uod']:
+                    if option in ['uo', 'od', 'uod', 'retry', 'worker', 'verify', 'watch']:
                         option_mode = option
+                    elif option == 'i':
+                        settings['incremental'] = True
+                    elif option == 'merge':
+                        settings['merge'] = True
                     else:
                         logger.error('not supported option {}'.format(arg))
                         option_mode = None
                 elif len(parts) == 2:
-                    if parts[0].strip().lower() == 'k':
+                    key = parts[0].strip().lower()
+                    if key == 'k':
                         option_keywords = parts[1].strip()
+                    elif key == 'x':
+                        settings['cache_invalidate'] = parts[1].strip()
+                    elif key == 'm':
+                        settings['metrics_file'] = parts[1].strip()
+                    elif key == 'q':
+                        settings['queue'] = parts[1].strip()
+                    elif key == 'sync' and parts[1].strip().isdigit():
+                        settings['sync_size'] = int(parts[1].strip())
+                    elif key == 'share' and parts[1].strip().isdigit():
+                        settings['rate_share'] = max(1, int(parts[1].strip()))
+                    elif key == 'l' and parts[1].strip().lower() in utility.log_formats:
+                        settings['log_format'] = parts[1].strip().lower()
+                    elif key in setting_options:
+                        try:
+                            settings[setting_options[key]] = max(1, int(parts[1].strip()))
+                        except ValueError:
+                            logger.error('not supported option value {}'.format(arg))
+                            option_mode = None
                     else:
                         logger.error('not supported option {}'.format(arg))
                         option_mode = None
@@ -58,73 +124,195 @@ def check_urls(args):
     return True
 
 
-def get_topics(param_mid, param_page_no=1, words=None, param_page_size=100):
-    adr = ("https://space.bilibili.com/ajax/member/getSubmitVideos?mid={}&pagesize={}&tid=0&page={"
-           "}&keyword=&order=pubdate").format(param_mid, param_page_size, param_page_no)
-    res = utility.request_url(adr)
-    if res is None:
-        return None
-    else:
+def get_topics_url(param_mid, param_page_no=1, param_page_size=100):
+    return ("https://space.bilibili.com/ajax/member/getSubmitVideos?mid={}&pagesize={}&tid=0&page={"
+            "}&keyword=&order=pubdate").format(param_mid, param_page_size, param_page_no)
+
+
+def get_topics_page(param_mid, param_page_no=1, param_page_size=100, param_retries=3):
+    adr = get_topics_url(param_mid, param_page_no, param_page_size)
+    for attempt in range(param_retries + 1):
+        if attempt > 0:
+            delay = utility.backoff(attempt - 1)
+            logger.debug('failed to get video topics. retry %s in %.2fs', adr, delay)
+            metrics.count('page_retries')
+            time.sleep(delay)
+        res = utility.request_url(adr)
+        if res is None:
+            continue
         try:
-            result = []
             content = res.read()
             content = content.decode('utf-8')
             data = json.loads(content)
             status = data['status']
             if status:
-                data = data['data']
-                # tlist = data['tlist'] #do not need so far
-                vlist = data['vlist']
-                for item in vlist:
-                    title = item['title']
-                    if utility.has_keywords(title, words):
-                        result.append(
-                            dict(pages=data['pages'], count=data['count'], ref=adr, mid=param_mid, aid=item['aid'],
-                                 title=title))
-                return result
+                return data['data']
             else:
-                logger.error('error : failed to get video topics {} from {}'.format(data['data'], adr))
-                return None
+                logger.debug('failed to get video topics %s from %s', data['data'], adr)
         except Exception as e:
-            logger.error('error : failed to get video topics {} from {}'.format(e, adr))
+            logger.debug('failed to get video topics from %s. %s', adr, e)
+    logger.error('error : failed to get video topics from {} after {} attempt(s)'.format(adr, param_retries + 1))
+    metrics.count('page_failures')
+    return None
+
+
+def filter_topics(param_mid, data, param_ref, words=None):
+    result = []
+    # tlist = data['tlist'] #do not need so far
+    vlist = utility.compile_keywords(words).filter(data['vlist'], key=lambda item: item['title'])
+    for item in vlist:
+        result.append(
+            dict(pages=data['pages'], count=data['count'], ref=param_ref, mid=param_mid, aid=item['aid'],
+                 title=item['title']))
+    return result
+
+
+def known_position(data, known):
+    # position of the first known aid in the page, -1 when the page has none
+    if known is not None:
+        for i, item in enumerate(data['vlist']):
+            if str(item['aid']) in known:
+                return i
+    return -1
+
+
+def load_topic_pages(param_mid, words=None, workers=8, known=None, lost=None):
+    # yields the topics of the channel page by page in pubdate order. page 1 tells pages/count, the
+    # next pages are fetched in parallel a window ahead of the consumer. with known aids (incremental
+    # crawl) it stops at the first known aid, since everything after it is older. the numbers of the
+    # pages that failed to load are appended to lost
+    if lost is None:
+        lost = []
+
+    def fetch(no):
+        with metrics.phase('pagination'):
+            return get_topics_page(param_mid, no)
+
+    data = fetch(1)
+    if data is None:
+        lost.append(1)
+        return
+    try:
+        pages = max(int(data['pages']), 1)
+        count = data['count']
+    except Exception as e:
+        logger.error('error : failed to get video topics {} from page 1 of {}'.format(e, param_mid))
+        lost.append(1)
+        return
+
+    print('{} topics in {} pages to be loaded'.format(count, pages))
+    aids = set()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+                contextlib.closing(utility.ordered_map(executor, fetch, range(2, pages + 1), workers * 2)) as results:
+            for no, data in enumerate(itertools.chain([data], results), 1):
+                utility.reporter.stage('pages', no, pages)
+                if data is None:
+                    lost.append(no)
+                    continue
+                try:
+                    position = known_position(data, known)
+                    if position >= 0:
+                        data = dict(data, vlist=data['vlist'][:position])
+                    topics = filter_topics(param_mid, data, get_topics_url(param_mid, no), words)
+                except Exception as e:
+                    logger.error('error : failed to get video topics {} from page {} of {}'.format(e, no, param_mid))
+                    lost.append(no)
+                    continue
+                for topic in topics:
+                    if topic['aid'] not in aids:  # a new upload during the crawl shifts the pages
+                        aids.add(topic['aid'])
+                        yield topic
+                if position >= 0:
+                    if no < pages:
+                        print('\nreached known topics at page {}/{}'.format(no, pages))
+                    return
+    finally:
+        utility.reporter.end_stage('pages')
+
+
+def find_cid(res, chunk_size=8192):
+    # scans the page while it is inflated chunk by chunk, and stops reading once the cid is parsed.
+    # the cid is the first "cid": after window.__INITIAL_STATE__, near the top of the page
+    state_marker, cid_marker = b'window.__INITIAL_STATE__', b'"cid":'
+    buffer = b''
+    found = False
+    while True:
+        chunk = res.read(chunk_size)
+        if not chunk:
             return None
+        buffer += chunk
+        if not found:
+            index1 = buffer.find(state_marker)
+            if index1 < 0:
+                buffer = buffer[-(len(state_marker) - 1):]  # a marker may be split across chunks
+                continue
+            buffer = buffer[index1:]
+            found = True
+        index2 = buffer.find(cid_marker)
+        if index2 > 0:
+            index3 = buffer.find(b',', index2)
+            if index3 > 0:
+                return buffer[index2 + len(cid_marker): index3].decode('utf-8')
 
 
-def get_cid(param_aid, param_ref, param_retry=0):
+def get_cid(param_aid, param_ref, param_retries=3):
     headers = utility.get_generic_request_headers()
     headers['Referer'] = param_ref
-    headers['"Accept-Encoding"'] = 'gzip, deflate'
     adr = "https://www.bilibili.com/video/av{}".format(param_aid)
-    res = utility.request_url(adr, headers)
-    if res is None:
-        return None
-    else:
+    for attempt in range(param_retries + 1):
+        if attempt > 0:
+            delay = utility.backoff(attempt - 1)
+            logger.debug('failed to get cid. retry %s in %.2fs', adr, delay)
+            metrics.count('cid_retries')
+            time.sleep(delay)
+        res = utility.request_url(adr, headers)
+        if res is None:
+            continue
         try:
-            content = res.read()
-            gzipped = res.headers.get('Content-Encoding')
-            if gzipped:
-                content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
-                content = content.decode('utf-8')
-            index1, index2, index3 = 0, 0, 0
-            index1 = content.find('window.__INITIAL_STATE__')
-            if index1 > 0:
-                index2 = content.find("\"cid\":", index1)
-            if index2 > 0:
-                index3 = content.find(",", index2)
-            if 0 < index1 < index2 < index3:
-                cid_result = content[index2 + 6: index3]
+            cid_result = find_cid(res)
+            if cid_result is not None:
                 return cid_result
             else:
-                if param_retry < 3:
-                    logger.debug('failed to get cid. retry {}'.format(adr))
-                    return get_cid(param_aid, param_ref, param_retry + 1)
-                else:
-                    logger.error('error : failed to find cid from {}, tried ({},{},{})'
-                                 .format(adr, index1, index2, index3))
-                    return None
+                logger.debug('failed to find cid from %s', adr)
         except Exception as e:
-            logger.error('error : failed to find cid from {}. {}'.format(adr, e))
-            return None
+            logger.debug('failed to find cid from %s. %s', adr, e)
+        finally:
+            res.close()  # the rest of the page is not needed
+    logger.error('error : failed to find cid from {} after {} attempt(s)'.format(adr, param_retries + 1))
+    metrics.count('cid_failures')
+    return None
+
+
+def lookup_cid(aid, ref, cid=None):
+    # the cid of a topic, given (saved in a csv), cached or loaded from its video page
+    if cid:
+        if cid_cache is not None:
+            cid_cache.put(aid, cid)
+        return cid
+    if cid_cache is not None:
+        cid = cid_cache.get(aid)
+    if cid is None:
+        logger.debug('loading cid with aid=%s ref=%s', aid, ref)
+        with metrics.phase('cid'):
+            cid = get_cid(aid, ref)
+        if cid is not None and cid_cache is not None:
+            cid_cache.put(aid, cid)
+    return cid
+
+
+def resolve_cids(topics, workers=8, ref='ref'):
+    # yields (topic, cid) in the order of topics, cid is None when failed. the cids are looked up
+    # in parallel a window ahead of the consumer
+    def lookup(topic):
+        return topic, lookup_cid(topic['aid'], topic[ref], topic.get('cid'))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+            contextlib.closing(utility.ordered_map(executor, lookup, topics, workers * 2)) as results:
+        for result in results:
+            yield result
+    if cid_cache is not None:
+        cid_cache.commit()
 
 
 def get_videos(param_mid, param_aid, param_cid, param_title):
@@ -156,262 +344,772 @@ def get_videos(param_mid, param_aid, param_cid, param_title):
             return None
 
 
+def durl_expiry(url):
+    # the deadline the cdn put in the query of a durl, or durl_ttl from now
+    query = parse.parse_qs(parse.urlsplit(url).query)
+    for name in ['deadline', 'expires']:
+        try:
+            return float(query[name][0])
+        except (KeyError, ValueError):
+            pass
+    return time.time() + durl_ttl
+
+
+def resolve_videos(mid, aid, cid, title):
+    # get_videos with the expiry of every durl, None when they can not be loaded
+    with metrics.phase('durl'):
+        try:
+            videos = get_videos(mid, aid, cid, title)
+        except Exception as e:
+            logger.error('error : failed to get video info {}'.format(e))
+            videos = None
+    for video in videos or []:
+        video['expires'] = durl_expiry(video['url'])
+    return videos
+
+
 def load_topics(urls, words=None):
+    # yields the topics of every url as soon as their cid is known, each one appended to the csv
+    # file of its mid first. returns the mids whose crawl lost pages, their new topics are not merged
+    # into the saved ones so the next incremental crawl loads them again
     if not check_urls(urls):
         exit(-1)
-    else:
-        results = []
-        idx = 0
-        for url in urls:
-            idx += 1
-            print('processing url(s) {}/{} : {}'.format(idx, len(urls), url))
-            mid = (url.split('/'))[3]
-            if len(mid) == 0:
-                logger.warning('error : failed to locate mid')
+    loaded = 0
+    failed = []
+    for idx, url in enumerate(urls, 1):
+        print('processing url(s) {}/{} : {}'.format(idx, len(urls), url))
+        mid = (url.split('/'))[3]
+        if len(mid) == 0:
+            logger.warning('error : failed to locate mid')
+            continue
+        known = None
+        if settings.get('incremental'):
+            known = load_known_aids(mid)
+            if known is not None:
+                print('{} topics known in {}, loading new topics only'.format(len(known), output_file_name(mid)))
+        print('loading topics ...')
+        output = OutputWriter(mid, bool(settings.get('incremental')))
+        completed = False
+        lost = []
+        try:
+            topics = load_topic_pages(mid, words, settings['page_workers'], known, lost)
+            for topic, cid in resolve_cids(topics, settings['cid_workers']):
+                result = dict(mid=mid, aid=topic['aid'], cid=cid, title=topic['title'], url=url)
+                if cid is None:
+                    # failed to get cid, save to error file
+                    result['cid'] = ''
+                    save_failed_topic(result)
+                    continue
+                output.write(result)
+                loaded += 1
+                metrics.count('topics')
+                yield result
+            if len(lost) > 0:
+                logger.error('error : failed to load page(s) {} of {}'.format(', '.join(map(str, lost)), mid))
+                failed.append(mid)
             else:
-                print('loading topics primary data ...')
-                page = 1
-                topics = get_topics(mid, page)
-                if topics is not None:
-                    pages = topics[0]['pages']
-                    count = topics[0]['count']
-
-                    print('{} topics in {} pages to be loaded'.format(count, pages))
-                    # reload and apply keywords
-                    topics = []
-                    utility.progress_bar(0, pages, prefix='Progress:', suffix='Complete', length=50)
-                    page = 0
-                    while page < pages:
-                        page += 1
-                        new_page_topics = get_topics(mid, page, words)
-                        if new_page_topics is not None:
-                            topics.extend(new_page_topics)
-                        utility.progress_bar(page, pages, prefix='Progress:', suffix='Complete', length=50)
-                    if len(topics) > 0:
-                        print('loading cid for {} topic(s)'.format(len(topics)))
-                        step = 0
-                        utility.progress_bar(step, len(topics), prefix='Progress:', suffix='Complete', length=50)
-                        for topic in topics:
-                            step += 1
-                            ref = topic['ref']
-                            title = topic['title']
-                            aid = topic['aid']
-                            cid = get_cid(aid, ref)
-                            if cid is not None:
-                                results.append(dict(mid=mid, aid=aid, cid=cid, title=title, url=url))
-                            else:
-                                # failed to get cid, save to error file
-                                save_failed_download(dict(mid=mid, aid=aid,cid='', title=title, url=url))
-                            utility.progress_bar(step, len(topics), prefix='Progress:', suffix='Complete', length=50)
-        print('{} topics loaded.'.format(len(results)))
-        return results
-
-
-def save_outputs(topics):
-    groups = {}
-    for topic in topics:
-        mid = topic['mid']
-        if mid not in groups:
-            groups[mid] = []
-        groups[mid].append(topic)
-    print('saving {} topics(s) to {} file(s) ...'.format(len(topics), len(groups.keys())))
-    results = []
+                completed = True
+        finally:
+            output.close(completed)
+        if output.count > 0:
+            all_files.append(output.fn)
+    print('{} topics loaded.'.format(loaded))
+    return failed
+
+
+def output_file_name(mid):
+    return os.path.join(mid, '{}.csv'.format(mid))
+
+
+def load_known_aids(mid):
+    # aids of the topics saved by the last run, None when the channel was never saved
+    fn = output_file_name(mid)
+    if not os.path.isfile(fn):
+        return None
     try:
-        headers = ['mid', 'aid', 'cid', 'title', 'url']
-        for k, v in groups.items():
-            if not os.path.exists(k):
-                os.makedirs(k)
-                logger.debug('folder {} created'.format(k))
-            fn = '{0}\\{0}.csv'.format(k)
-            print('saving {} topics to {} ...'.format(len(v), fn))
-            with open(fn, 'w', newline='', encoding='utf-8')as f:
-                writer = csv.DictWriter(f, headers)
-                writer.writeheader()
-                writer.writerows(v)
-            print('{} topics saved in {}'.format(len(v), fn))
-            results.append(fn)
+        with open(fn, 'r', encoding="utf-8") as f:
+            return set(row['aid'] for row in csv.DictReader(f))
     except Exception as e:
-        logger.error('error : failed to save topics. {}'.format(e))
-    return results
+        logger.error('error : failed to load known topics from {}. {}'.format(fn, e))
+        return None
+
+
+class OutputWriter:
+    # appends the topics of a mid to <mid>/<mid>.csv.part as they are loaded, renamed to <mid>.csv once
+    # the crawl completed. when merging (incremental) they are put on top of the saved ones instead. the
+    # topics of a failed crawl stay in the part file, they are never taken for the saved topics of the mid
+    headers = ['mid', 'aid', 'cid', 'title', 'url']
+
+    def __init__(self, mid, merge=False):
+        self.mid = mid
+        self.fn = output_file_name(mid)
+        self.merge = merge
+        self.path = self.fn + '.part'
+        self.file = None
+        self.writer = None
+        self.aids = set()
+        self.count = 0
+
+    def write(self, topic):
+        if self.file is None:  # opened by the first topic, a failed crawl keeps the saved file
+            if not os.path.exists(self.mid):
+                os.makedirs(self.mid)
+                logger.debug('folder {} created'.format(self.mid))
+            self.file = open(self.path, 'w', newline='', encoding='utf-8')
+            self.writer = csv.DictWriter(self.file, self.headers)
+            self.writer.writeheader()
+        self.writer.writerow(topic)
+        self.file.flush()  # a crash does not lose the topics loaded so far
+        if self.merge:
+            self.aids.add(str(topic['aid']))
+        self.count += 1
+
+    def close(self, completed=True):
+        if self.file is None:
+            return
+        self.file.close()
+        if not completed:
+            print('{} topics left in {}'.format(self.count, self.path))
+        elif not self.merge or not os.path.isfile(self.fn):
+            os.replace(self.path, self.fn)
+            print('{} topics saved in {}'.format(self.count, self.fn))
+        else:
+            # the merged topics of a failed crawl would hide the ones it missed from the next run
+            kept = 0
+            with open(self.path, 'r', encoding='utf-8') as new, open(self.fn, 'r', encoding='utf-8') as old, \
+                    open(self.fn + '.tmp', 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, self.headers)
+                writer.writeheader()
+                writer.writerows(csv.DictReader(new))
+                for row in csv.DictReader(old):
+                    if row['aid'] not in self.aids:
+                        writer.writerow(row)
+                        kept += 1
+            os.replace(self.fn + '.tmp', self.fn)
+            os.remove(self.path)
+            print('{} new topics merged into {} topics in {}'.format(self.count, kept, self.fn))
+
+
+def read_outputs(files, words):
+    # the rows of the csv files having the keywords, read lazily
+    words = utility.compile_keywords(words)
+    for fn in files:
+        print('loading topics from {}'.format(fn))
+        if not os.path.isfile(fn):
+            logger.error('file {} is not found'.format(fn))
+            continue
+        try:
+            with open(fn, 'r', encoding="utf-8") as f:
+                reader = csv.reader(f)
+                headers = next(reader)
+                if not headers == OutputWriter.headers:
+                    logger.error('file headers {} is not acceptable'.format(fn))
+                    continue
+                for row in csv.DictReader(f, fieldnames=headers):
+                    if words.search(row['title']):
+                        yield row
+        except Exception as e:
+            logger.error('error : failed to load topics from {}. {}'.format(fn, e))
 
 
 def load_outputs(files, words):
+    # yields the topics of the csv files, a missing cid is loaded again on the way
     print('loading {} file(s) ...'.format(len(files)))
-    topics = []
+    loaded = 0
+    for topic in resolve_topics(read_outputs(files, words)):
+        loaded += 1
+        yield topic
+    print('{} topics(s) loaded ...'.format(loaded))
+
+
+def load_failed(mids):
+    # yields the failed topics of the job database, of the given mids only when there are some
+    topics = job_db.failed_topics(mids)
+    print('{} failed topic(s) to retry'.format(len(topics)))
+    return resolve_topics(topics)
+
+
+def poll_channel(mid):
+    # page 1 of a watched channel, its count tells whether there are new uploads
+    with metrics.phase('poll'):
+        return get_topics_page(mid, 1, 30)
+
+
+def watch_topics(lists, words=None):
+    # the -watch daemon, yields the new topics of the channels of the list files until it is stopped by
+    # ctrl-c or sigterm. a channel is polled when its schedule says so, and crawled incrementally only when
+    # the count of page 1 grew. the lists are read again when they change
+    schedule = watch.WatchSchedule(min_interval=settings['poll_interval'] * 60)
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        print('stopping once the current crawl is done ...')
+        stopped.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)  # a second ctrl-c does not wait
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+    print('watching the channels of {}, ctrl-c to stop'.format(', '.join(lists)))
+    loaded = None
+    batch = settings['page_workers'] * 4
     try:
-        for fn in files:
-            print('loading topics from {}'.format(fn))
-            if os.path.isfile(fn):
-                with open(fn, 'r', encoding="utf-8") as f:
-                    reader = csv.reader(f)
-                    headers = next(reader)
-                    if not headers == ['mid', 'aid', 'cid', 'title', 'url']:
-                        logger.error('file headers {} is not acceptable'.format(fn))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=settings['page_workers']) as executor:
+            while not stopped.is_set():
+                try:
+                    modified = [os.path.getmtime(fn) for fn in lists]
+                    if modified != loaded:
+                        mids = [mid for fn in lists for mid in watch.read_channels(fn)]
+                        added, removed = schedule.sync(mids)
+                        print('{} channel(s) watched, {} added, {} removed'.format(len(set(mids)), added, removed))
+                        loaded = modified
+                except OSError as e:
+                    logger.error('error : failed to read the channel list. {}'.format(e))
+
+                due = schedule.due(time.time(), batch)
+                for mid, data in zip(due, executor.map(poll_channel, due)):
+                    metrics.count('polls')
+                    try:
+                        count = int(data['count'])
+                        created = [int(item['created']) for item in data['vlist'] if 'created' in item]
+                    except Exception as e:
+                        logger.warning('error : failed to poll {}. {}'.format(mid, e))
+                        schedule.failed(mid)
                         continue
-                    reader = csv.DictReader(f, fieldnames=headers)
-                    for row in reader:
-                        title = row['title']
-                        if utility.has_keywords(title, words):
-                            topics.append(row)
-            else:
-                logger.error('file {} is not found'.format(fn))
-            if len(topics) > 0:
-                for topic in topics:
-                    # check if the cid is not valid
-                    aid = topic['aid']
-                    cid = topic['cid']
-                    ref = topic['url']
-                    title = topic['title']
-                    if len(cid.strip()) == 0:
-                        logger.debug('missing cid, loading cid with aid={} ref={}'.format(aid, ref))
-                        print('fetching missing cid for {}'.format(title))
-                        cid = get_cid(aid, ref)
-                        if cid is not None:
-                            topic[cid] = cid
-    except Exception as e:
-        logger.error('error : failed to load topics'.format(e))
-    print('{} topics(s) loaded ...'.format(len(topics)))
-    return topics
+                    if not schedule.has_new(mid, count):
+                        schedule.update(mid, count, created)
+                        continue
+                    lost = yield from load_topics(['https://space.bilibili.com/{}/video'.format(mid)], words)
+                    if len(lost) > 0:
+                        schedule.failed(mid)  # its new topics were not merged, the next poll crawls them again
+                    else:
+                        schedule.update(mid, count, created, crawled=True)
+                    if stopped.is_set():
+                        break
+                if work_queue is not None:
+                    collect_downloads()  # -retry sees the failed ones while the daemon runs
+                if len(due) > 0 or work_queue is not None:
+                    if job_db is not None:
+                        job_db.commit()
+                    cid_cache.commit()
+                    prune_finished()
+                if len(due) < batch:
+                    following = schedule.next_poll()
+                    stopped.wait(min(max((following or time.time()) - time.time(), 1), 60))
+    finally:
+        stats = schedule.stats()
+        print('{channels} channel(s) watched, {polls} poll(s), {crawls} crawl(s) so far'.format(**stats))
+        schedule.close()
+
+
+def resolve_topics(topics):
+    for topic, cid in resolve_cids(topics, settings['cid_workers'], 'url'):
+        if cid is None:
+            save_failed_topic(topic)
+            continue
+        topic['cid'] = cid
+        metrics.count('topics')
+        yield topic
+
 
+def start_downloads(size=20):
+    # the topics are given by add_topic while they are loaded, finish_downloads waits for the last one
+    global download_engine, durl_engine, merge_engine, download_closed, download_stopped, download_began, \
+        all_topics, all_downloads
+    print('topics are downloaded by max {} parallelled downloads, with up to {} durls resolved ahead ...'.format(
+        size, size))
+    with download_lock:
+        all_topics, all_downloads = jobs.JobStore(), jobs.JobStore()
+        download_done.clear()
+        download_closed = False
+        download_stopped = False
+        download_began = None
+        pruned[:] = [0, 0]
+    download_engine = concurrent.futures.ThreadPoolExecutor(max_workers=size)
+    # the durl api is limited like the cid api, more resolutions at once would only wait for the limiter
+    durl_engine = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(size, settings['cid_workers'])))
+    merge_engine = concurrent.futures.ThreadPoolExecutor(max_workers=1) if settings.get('merge') else None
 
-def process_download(size=20):
-    global all_topics  # depends on global all_topics, all_downloads
-    print('{} topics(s) to download by max {} parallelled processes ...'.format(len(all_topics), size, ))
+
+def add_topic(topic, size=20):
+    if job_db is not None and job_db.is_completed(topic['aid']):
+        metrics.count('topics_skipped')  # downloaded by an earlier run
+        return
+    with download_lock:
+        all_topics.add(jobs.Topic(topic['mid'], topic['aid'], topic['cid'], topic['title'], topic['url']))
+    download_tasks(size)
+
+
+def finish_downloads(size=20):
+    global download_closed
+    with download_lock:
+        download_closed = True
     download_tasks(size)
+    download_done.wait()
+    download_engine.shutdown()
+    durl_engine.shutdown()
+    if merge_engine is not None:
+        merge_engine.shutdown()  # the last merges finish before the counts
+    utility.reporter.end_stage('topics')
+    if download_began is not None:
+        metrics.add_phase('download', download_began, time.perf_counter())
+
+    cnt_waiting, cnt_doing, cnt_completed, cnt_failed = update_download_tasks_status()
+    transferred = sum(download.size for download in all_downloads) + pruned[1]
+    cnt_completed += pruned[0]
+    print('{} file(s) downloaded, {} failed, {:.1f} MB transferred'.format(cnt_completed, cnt_failed,
+                                                                          transferred / 1024 / 1024))
+    if metrics.value('topics_skipped') > 0:
+        print('{} topic(s) completed by an earlier run skipped'.format(metrics.value('topics_skipped')))
+
+
+def stop_downloads():
+    # ctrl-c, the running downloads finish and are recorded, the ones not started yet are left to the next run
+    global download_stopped
+    with download_lock:
+        download_stopped = True
+        running = all_downloads.count(jobs.Status.DOING)
+    print('\ninterrupted, waiting for {} running download(s) ...'.format(running))
+    durl_engine.shutdown(cancel_futures=True)
+    download_engine.shutdown(cancel_futures=True)
+    if merge_engine is not None:
+        merge_engine.shutdown()
 
 
 def download_tasks(size):
-    global all_topics
-    cnt_waiting, cnt_doing, cnt_completed, cnt_terminated, cnt_killed = update_download_tasks_status()
-    cnt_topic_waiting, cnt_topic_completed, cnt_topic_downloading, cnt_topic_failed = count_topic_download_status()
-
-    free_space = size - cnt_doing - cnt_waiting
-    cnt_topic_remains = 0
-    cnt = 0
-    for topic in all_topics:
-        if cnt_topic_completed + cnt_topic_failed < len(all_topics):  # to avoid double progress bar
-            utility.progress_bar(cnt_topic_completed + cnt_topic_failed,
-                                 len(all_topics), prefix='Scanning:', suffix='Complete', length=50)
-        if 'download' not in topic:
-            if free_space > 0:
-                cnt += 1
-                utility.progress_bar(cnt_topic_completed + cnt_topic_failed, len(all_topics),
-                                     prefix='Loading :', suffix='{}/{}     '.format(cnt, free_space), length=50)
-                mid = topic['mid']
-                aid = topic['aid']
-                cid = topic['cid']
-                title = topic['title']
-                videos = get_videos(mid, aid, cid, title)
-                if videos is None:
-                    topic['url'] = ''
-                    save_failed_download(topic)
-                else:
-                    for video in videos:
-                        video['status'] = 0  # waiting to start
-                        video['process'] = None
-                    all_downloads.extend(videos)
-                    topic['download'] = videos
-                    free_space -= len(videos)
+    # fills the free download slots with resolved downloads and keeps up to size downloads resolved ahead of
+    # them. called on start, by every finished download and by every finished resolution, it never waits for
+    # the durl api itself
+    global loading_topics
+    topics, expired = [], []
+    with download_lock:
+        if download_stopped:
+            return
+        while all_downloads.count(jobs.Status.DOING) < size:
+            download = all_downloads.pop()
+            if download is None:
+                break
+            if download.expires is not None and download.expires < time.time() + durl_margin:
+                expired.append(download)  # waited in the lookahead longer than its durl lives
+                loading_topics += 1
+                continue
+            trigger_downloads(download, size)
+        while loading_topics + all_downloads.count(jobs.Status.WAITING) < size:
+            topic = all_topics.pop()
+            if topic is None:
+                break
+            all_topics.set_status(topic, jobs.Status.DOING)
+            loading_topics += 1
+            if job_db is not None:
+                job_db.set_topic_status(topic.aid, jobs.Status.DOING)
+            topics.append(topic)
+        if all_downloads.count(jobs.Status.DOING) == 0 and all_downloads.count(jobs.Status.WAITING) == 0 and \
+                all_topics.count(jobs.Status.WAITING) == 0 and loading_topics == 0 and download_closed:
+            download_done.set()
+    for topic in topics:
+        durl_engine.submit(resolve_durls, topic, size)
+    for download in expired:
+        durl_engine.submit(refresh_durl, download, size)
 
-            else:
-                cnt_topic_remains += 1
 
-    trigger_downloads(size)
+def resolve_durls(topic, size):
+    # the lookahead stage, the downloads of a topic wait for a slot with their durls known
+    global loading_topics
+    videos = resolve_videos(topic.mid, topic.aid, topic.cid, topic.title)
+    with download_lock:
+        loading_topics -= 1
+        if videos is None or len(videos) == 0:
+            metrics.count('durl_failures')
+            save_failed_download(dict(topic.row(), url=''))
+            set_topic_status(topic, jobs.Status.FAILED)
+        else:
+            # the segments completed by an earlier run are not downloaded again
+            done = job_db.completed_files(topic.aid) if job_db is not None else {}
+            downloads = []
+            for video in videos:
+                if video['index'] not in done:
+                    download = jobs.Download(topic, video['url'], video['index'])
+                    download.expires = video['expires']
+                    downloads.append(download)
+            metrics.count('downloads_skipped', len(videos) - len(downloads))
+            topic.remains = len(downloads)
+            topic.parts = len(videos)
+            if topic.remains == 0:
+                set_topic_status(topic, jobs.Status.COMPLETED)
+            all_downloads.extend(downloads)
+    download_tasks(size)
 
-    cnt_waiting, cnt_doing, cnt_completed, cnt_terminated, cnt_killed = update_download_tasks_status()
-    cnt_topic_waiting, cnt_topic_completed, cnt_topic_downloading, cnt_topic_failed = count_topic_download_status()
 
-    utility.progress_bar(cnt_topic_completed + cnt_topic_failed,
-                         len(all_topics), prefix='Progress:', suffix='Complete', length=50)
+def refresh_durl(download, size):
+    # an expired download taken off the lookahead gets a new durl and goes back to the head of it
+    global loading_topics
+    topic = download.topic
+    videos = resolve_videos(topic.mid, topic.aid, topic.cid, topic.title)
+    url = next((video['url'] for video in videos or [] if video['index'] == download.index), None)
+    with download_lock:
+        loading_topics -= 1
+        if url is None:
+            metrics.count('durl_failures')
+            set_download_status(download, jobs.Status.FAILED, error='failed to resolve the expired durl again')
+            on_download_failed(download, 'failed to resolve the expired durl again')
+        else:
+            metrics.count('durl_refreshes')
+            download.url = url
+            download.expires = None  # just resolved, downloaded next whatever its deadline says
+            all_downloads.retake(download)
+    download_tasks(size)
 
-    if cnt_topic_remains > 0 or cnt_waiting > 0 or cnt_doing > 0:
-        timer = threading.Timer(2.0, download_tasks, [size])
-        timer.start()
 
+def trigger_downloads(download, size):
+    # starts a waiting download taken off all_downloads, download_lock is held by the caller
+    global download_began
+    if download_began is None:
+        download_began = time.perf_counter()
+    topic = download.topic
+    try:
+        logger.debug('downloading %s %s-%s', download.url, topic.title, download.index)
+        download.future = download_engine.submit(downloader.download, download.url, topic.mid, topic.title,
+                                                 str(download.index), segments=settings['segments'],
+                                                 min_segment_size=settings['min_segment_size'] * 1024 * 1024)
+        all_downloads.set_status(download, jobs.Status.DOING)
+        download.future.add_done_callback(lambda f: on_download_done(download, f, size))
+    except Exception as e:
+        logger.error('download error {}'.format(e))
+        download.future = None
+        set_download_status(download, jobs.Status.FAILED, error=e)
+        on_download_failed(download, e)
 
-def trigger_downloads(size):
-    global all_downloads, startupinfo
-    cnt_waiting, cnt_doing, cnt_completed, cnt_terminated, cnt_killed = update_download_tasks_status()
-    free_space = size - cnt_doing
 
-    if free_space > 0:
-        for download in all_downloads:
-            if free_space <= 0:
-                break
-            if download['status'] == 0:
-                try:
-                    adr = download['url']
-                    folder = download['mid']
-                    title = download['title']
-                    index = str(download['index'])
-                    adr = base64.urlsafe_b64encode(bytes(adr, 'utf-8')).decode('utf-8').rstrip('=')
-                    title = base64.urlsafe_b64encode(bytes(title, 'utf-8')).decode('utf-8').rstrip('=')
-                    command = ["python", "download.py", "{}".format(adr), folder, "{}".format(title), index]
-                    logger.debug('downloading command {}'.format(command))
-                    download['process'] = subprocess.Popen(command,
-                                                           startupinfo=startupinfo,
-                                                           creationflags=subprocess.CREATE_NEW_CONSOLE)
-                    download['status'] = 1
-                    free_space -= 1
-                except Exception as e:
-                    logger.error('download error {}'.format(e))
-                    download['process'] = None
-                    download['status'] = 0  # try next time
+def on_download_done(download, future, size):
+    if future.cancelled():  # never started, stopped by ctrl-c
+        return
+    if future.exception() is None:
+        result = future.result()
+    else:
+        result = dict(status='failed', size=0, error=future.exception())
+    with download_lock:
+        download.size = result['size']
+        download.future = None
+        metrics.count('downloads_' + result['status'])
+        if result['status'] != 'failed':  # download complete normally, or the file is there already
+            set_download_status(download, jobs.Status.COMPLETED, result.get('file'))
+            topic = download.topic
+            topic.remains -= 1
+            if topic.remains == 0 and topic.status == jobs.Status.DOING:
+                set_topic_status(topic, jobs.Status.COMPLETED)
+        else:
+            set_download_status(download, jobs.Status.FAILED, error=result['error'])
+            on_download_failed(download, result['error'])
+        cnt_topic_waiting, cnt_topic_completed, cnt_topic_downloading, cnt_topic_failed = count_topic_download_status()
+        utility.reporter.stage('topics', cnt_topic_completed + cnt_topic_failed, len(all_topics))
+    download_tasks(size)
+
+
+def on_download_failed(download, reason):
+    save_failed_download(download.row())
+    logger.warning('error : downloading file {} failed. {}'.format(download.topic.title, reason))
+    if download.topic.status != jobs.Status.FAILED:
+        set_topic_status(download.topic, jobs.Status.FAILED)
+
+
+def prune_finished():
+    # forgets the completed topics and downloads, a -watch daemon would keep them forever
+    with download_lock:
+        pruned[0] += all_downloads.count(jobs.Status.COMPLETED)
+        pruned[1] += sum(download.size for download in all_downloads.records(jobs.Status.COMPLETED))
+        all_topics.clear(jobs.Status.COMPLETED)
+        all_downloads.clear(jobs.Status.COMPLETED)
+
+
+def set_download_status(download, status, file=None, error=None):
+    # in the scheduler and in the job database, download_lock is held by the caller
+    all_downloads.set_status(download, status)
+    if job_db is not None:
+        job_db.put_download(download, status, file, error)
+
+
+def set_topic_status(topic, status):
+    all_topics.set_status(topic, status)
+    if job_db is not None:
+        job_db.set_topic_status(topic.aid, status)
+    if status == jobs.Status.COMPLETED and merge_engine is not None and topic.parts > 1:
+        merge_engine.submit(merge_topic, topic.mid, topic.title, topic.parts)  # as soon as its last part is there
+
+
+def merge_topic(mid, title, parts):
+    # joins <title>-1.flv .. <title>-<parts>.flv of a completed topic into <title>.flv, the parts are kept
+    name = utility.validated_file_name(title)
+    files = [os.path.join(mid, '{}-{}.flv'.format(name, index)) for index in range(1, parts + 1)]
+    output = os.path.join(mid, '{}.flv'.format(name))
+    try:
+        if os.path.isfile(output) and os.path.getmtime(output) >= max(os.path.getmtime(file) for file in files):
+            return  # merged by an earlier run
+        with metrics.phase('merge'):
+            flv.merge(files, output)
+        metrics.count('merges')
+    except Exception as e:
+        metrics.count('merge_failures')
+        logger.warning('error : failed to merge the parts of {} into {}. {}'.format(title, output, e))
 
 
 def update_download_tasks_status():
-    global all_downloads
-    cnt_waiting, cnt_doing, cnt_completed, cnt_terminated, cnt_killed = 0, 0, 0, 0, 0
-    for download in all_downloads:
-        proc = download['process']
-        if proc is not None:
-            if proc.poll() is None:  # downloading
-                download['status'] = 1
-                cnt_doing += 1
-            elif proc.poll() == 0:  # download complete normally
-                download['status'] = 2
-                cnt_completed += 1
-            elif proc.poll() < 0:  # killed
-                download['status'] = -1
-                cnt_killed += 1
-                if 'failed_logged' not in download:
-                    save_failed_download(download)
-                    logger.warning('error : downloading file {} was killed'.format(download['title']))
-                    download['failed_logged'] = True
-            else:
-                download['status'] = -2  # not sure what is happening
-                cnt_terminated += 1
-                if 'failed_logged' not in download:
-                    save_failed_download(download)
-                    logger.warning('error : downloading file {} was terminated'.format(download['title']))
-                    download['failed_logged'] = True
-        else:
-            download['status'] = 0  # waiting
-            cnt_waiting += 1
-    return cnt_waiting, cnt_doing, cnt_completed, cnt_terminated, cnt_killed
+    with download_lock:
+        return (all_downloads.count(jobs.Status.WAITING), all_downloads.count(jobs.Status.DOING),
+                all_downloads.count(jobs.Status.COMPLETED), all_downloads.count(jobs.Status.FAILED))
 
 
 def count_topic_download_status():
-    global all_topics
-    cnt_waiting, cnt_completed, cnt_downloading, cnt_failed = 0, 0, 0, 0
-    for topic in all_topics:
-        if 'download' in topic:
-            status = []
-            for download in topic['download']:
-                status.append(download['status'])
-            if len(status) > 0:
-                status.sort()
-                if status[0] == 0 and status[-1] == 0:  # every download is waiting
-                    cnt_waiting += 1
-                elif status[0] < 0:
-                    cnt_failed += 1
-                elif sum(status) / len(status) == 2:  # everything completed
-                    cnt_completed += 1
-                else:
-                    cnt_downloading += 1
-        else:
-            cnt_waiting += 1
-    return cnt_waiting, cnt_completed, cnt_downloading, cnt_failed
+    with download_lock:
+        return (all_topics.count(jobs.Status.WAITING), all_topics.count(jobs.Status.COMPLETED),
+                all_topics.count(jobs.Status.DOING), all_topics.count(jobs.Status.FAILED))
+
+
+def page_unit(mid, no, incremental=False):
+    return dict(kind='page', key='{}/{}'.format(mid, no), grp=mid, seq=no, priority=0,
+                payload=dict(mid=mid, no=no, incremental=incremental))
+
+
+def run_page_unit(payload):
+    # one page of a channel, the cids of its topics and the next pages become units of the queue
+    mid, no = payload['mid'], payload['no']
+    with metrics.phase('pagination'):
+        data = get_topics_page(mid, no)
+    if data is None:
+        raise Exception('failed to load page {} of {}'.format(no, mid))
+    known = None
+    if payload['incremental']:
+        with download_lock:
+            if mid not in known_topics:
+                known_topics[mid] = load_known_aids(mid)
+            known = known_topics[mid]
+    pages = max(int(data['pages']), 1)
+    position = known_position(data, known)
+    if position >= 0:
+        data = dict(data, vlist=data['vlist'][:position])
+    ref = get_topics_url(mid, no)
+    topics = filter_topics(mid, data, ref, work_keywords)
+    children = [dict(kind='cid', key=topic['aid'], grp=mid, priority=1, payload=dict(aid=topic['aid'], ref=ref))
+                for topic in topics]
+    if position < 0 and no < pages:
+        if known is not None:  # an incremental crawl goes page by page until a known aid
+            children.append(page_unit(mid, no + 1, True))
+        elif no == 1:
+            children.extend(page_unit(mid, other) for other in range(2, pages + 1))
+    return dict(pages=pages, reached=position >= 0, topics=[[topic['aid'], topic['title']] for topic in topics]), \
+        children
+
+
+def run_cid_unit(payload):
+    return dict(cid=lookup_cid(payload['aid'], payload['ref'])), ()
+
+
+def run_download_unit(topic):
+    # the durls of a topic downloaded one after the other, the ones completed by an earlier run are skipped.
+    # the durls left once one of them expired are resolved again. a topic is one unit rather than one per durl:
+    # a single durl request gives all its parts, which expire together and are resolved by the worker about to
+    # download them, and a merged topic needs all its parts in one place
+    videos = resolve_videos(topic['mid'], topic['aid'], topic['cid'], topic['title'])
+    if videos is None or len(videos) == 0:
+        metrics.count('durl_failures')
+        return dict(topic=topic, status='failed', downloads=[]), ()
+    durls = dict((video['index'], video) for video in videos)
+    downloads = []
+    for index in list(durls):
+        if index in topic['done']:
+            metrics.count('downloads_skipped')
+            continue
+        if durls[index]['expires'] < time.time() + durl_margin:
+            metrics.count('durl_refreshes')  # the old durl is tried when they can not be resolved again
+            durls.update((video['index'], video) for video in resolve_videos(topic['mid'], topic['aid'], topic['cid'],
+                                                                             topic['title']) or [])
+        video = durls[index]
+        with metrics.phase('download'):
+            result = downloader.download(video['url'], topic['mid'], topic['title'], str(video['index']),
+                                         segments=settings['segments'],
+                                         min_segment_size=settings['min_segment_size'] * 1024 * 1024)
+        metrics.count('downloads_' + result['status'])
+        downloads.append(dict(index=video['index'], url=video['url'], file=result['file'], size=result['size'],
+                              status=result['status'], error=result['error']))
+    status = 'failed' if any(download['status'] == 'failed' for download in downloads) else 'completed'
+    if status == 'completed' and settings.get('merge') and len(durls) > 1:
+        merge_topic(topic['mid'], topic['title'], len(durls))
+    return dict(topic=topic, status=status, downloads=downloads), ()
+
+
+unit_runners = dict(page=run_page_unit, cid=run_cid_unit, download=run_download_unit)
+
+
+def work(queue):
+    # a worker process of a -q:file run, leases the units of the queue until the coordinator closed the run
+    # and nothing is left. the crawl units and the downloads have their own threads
+    owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+    held = set()
+    held_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(queue.ttl / 3):
+            with held_lock:
+                ids = list(held)
+            try:
+                queue.heartbeat(owner, ids)
+            except Exception as e:
+                logger.warning('heartbeat of {} failed. {}'.format(owner, e))
+
+    def lease(kinds):
+        idle = 0.1
+        while True:
+            units = queue.lease(owner, kinds)
+            if len(units) == 0:
+                if queue.get('closed', False) and queue.unfinished(kinds=kinds) == 0:
+                    return
+                time.sleep(idle)
+                idle = min(idle * 2, 2.0)
+                continue
+            idle = 0.1
+            unit = units[0]
+            with held_lock:
+                held.add(unit['id'])
+            try:
+                result, children = unit_runners[unit['kind']](unit['payload'])
+                queue.complete(unit, owner, result, children)
+            except Exception as e:
+                logger.error('error : {} {} failed. {}'.format(unit['kind'], unit['key'], e))
+                queue.fail(unit, owner, e)
+            finally:
+                with held_lock:
+                    held.discard(unit['id'])
+
+    print('worker {} working on {}'.format(owner, queue.path))
+    threading.Thread(target=beat, daemon=True).start()
+    threads = [threading.Thread(target=lease, args=(['page', 'cid'],))
+               for _ in range(max(settings['page_workers'], settings['cid_workers']))]
+    threads.extend(threading.Thread(target=lease, args=(['download'],)) for _ in range(settings['download_workers']))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stopped.set()
+    print('worker {} done'.format(owner))
+
+
+def coordinate_topics(urls):
+    # load_topics run by the workers of the queue, the pages and cids of the channels are units of it.
+    # the topics of a mid are written and yielded in the load_topics order once all its units finished
+    if not check_urls(urls):
+        exit(-1)
+    incremental = bool(settings.get('incremental'))
+    channels = [(url, (url.split('/'))[3]) for url in urls]
+    work_queue.put([page_unit(mid, 1, incremental) for url, mid in channels if len(mid) > 0])
+    loaded = 0
+    for idx, (url, mid) in enumerate(channels, 1):
+        print('processing url(s) {}/{} : {}'.format(idx, len(urls), url))
+        if len(mid) == 0:
+            logger.warning('error : failed to locate mid')
+            continue
+        while True:
+            counts = work_queue.counts(grp=mid)
+            total = sum(counts.values())
+            utility.reporter.stage('units of {}'.format(mid), total - counts['waiting'] - counts['doing'], total)
+            if work_queue.unfinished(mid, ['page', 'cid']) == 0:
+                break
+            time.sleep(0.2)
+        utility.reporter.end_stage('units of {}'.format(mid))
+        cids = dict((key, result['cid'] if result is not None else None)
+                    for key, status, result in work_queue.results('cid', mid))
+        output = OutputWriter(mid, incremental)
+        completed = False
+        try:
+            aids = set()
+            lost = False
+            for key, status, result in work_queue.results('page', mid):
+                if result is None:
+                    logger.error('error : failed to get video topics from page {}'.format(key))
+                    lost = True
+                    continue
+                for aid, title in result['topics']:
+                    if aid in aids:  # a new upload during the crawl shifts the pages
+                        continue
+                    aids.add(aid)
+                    topic = dict(mid=mid, aid=aid, cid=cids.get(str(aid)), title=title, url=url)
+                    if topic['cid'] is None:
+                        topic['cid'] = ''
+                        save_failed_topic(topic)
+                        continue
+                    output.write(topic)
+                    loaded += 1
+                    metrics.count('topics')
+                    yield topic
+                if result['reached']:
+                    break
+            completed = not lost
+        finally:
+            output.close(completed)
+        if output.count > 0:
+            all_files.append(output.fn)
+    print('{} topics loaded.'.format(loaded))
+
+
+def queue_download(topic):
+    if job_db.is_completed(topic['aid']):
+        metrics.count('topics_skipped')  # downloaded by an earlier run
+        return
+    done = list(job_db.completed_files(topic['aid']).keys())
+    work_queue.put([dict(kind='download', key=topic['aid'], grp=topic['mid'], priority=2,
+                         payload=dict(topic, done=done))])
+
+
+def finish_queued_downloads():
+    # waits for the download units, then keeps their outcome like the downloads of this process
+    while True:
+        counts = work_queue.counts('download')
+        total = sum(counts.values())
+        utility.reporter.stage('topics', counts['completed'] + counts['failed'], total)
+        if counts['waiting'] + counts['doing'] == 0:
+            break
+        time.sleep(0.5)
+    utility.reporter.end_stage('topics')
+    collect_downloads()
+    cnt_completed, cnt_failed, transferred = collected
+    print('{} file(s) downloaded, {} failed, {:.1f} MB transferred'.format(cnt_completed, cnt_failed,
+                                                                          transferred / 1024 / 1024))
+    if metrics.value('topics_skipped') > 0:
+        print('{} topic(s) completed by an earlier run skipped'.format(metrics.value('topics_skipped')))
+
+
+def collect_downloads():
+    # the finished download units are taken off the queue and kept in the job database and the failed csv,
+    # by a -watch daemon every round and once the downloads finished otherwise
+    for key, status, result in work_queue.take_finished('download'):
+        if result is None:
+            logger.error('error : download of topic {} failed'.format(key))
+            job_db.set_topic_status(key, jobs.Status.FAILED)
+            continue
+        topic = jobs.Topic(result['topic']['mid'], result['topic']['aid'], result['topic']['cid'],
+                           result['topic']['title'], result['topic']['url'])
+        if len(result['downloads']) == 0 and result['status'] == 'failed':
+            save_failed_download(dict(topic.row(), url=''))
+        for item in result['downloads']:
+            download = jobs.Download(topic, item['url'], item['index'])
+            download.size = item['size']
+            collected[2] += item['size']
+            if item['status'] == 'failed':
+                collected[1] += 1
+                job_db.put_download(download, jobs.Status.FAILED, error=item['error'])
+                save_failed_download(download.row())
+            else:
+                collected[0] += 1
+                job_db.put_download(download, jobs.Status.COMPLETED, item['file'])
+        job_db.set_topic_status(topic.aid, jobs.Status.FAILED if result['status'] == 'failed'
+                                else jobs.Status.COMPLETED)
+
+
+def start_workers(count):
+    # local worker processes, more of them can be started on other hosts sharing the queue file. they send
+    # from the same address, each one gets its share of the -r:n rate
+    command = [sys.executable, os.path.abspath(__file__), '-worker', '-q:{}'.format(settings['queue']),
+               '-share:{}'.format(count)]
+    return [subprocess.Popen(command, stdout=subprocess.DEVNULL) for _ in range(count)]
 
 
 def load_keywords(kwfn):
@@ -427,55 +1125,225 @@ def load_keywords(kwfn):
     return words
 
 
+def save_failed_topic(topic):
+    # a topic failed before its downloads started, kept for -retry too
+    if job_db is not None:
+        job_db.put_topic(topic, jobs.Status.FAILED)
+    save_failed_download(topic)
+
+
 def save_failed_download(dn):
     global runid
+    with failed_lock:  # downloads fail from several threads
+        try:
+            headers = ['mid', 'aid', 'cid', 'title', 'url']
+            fn = '{0}.csv'.format(runid)
+            print('saving failed topic to {} ...'.format(fn))
+            exist = os.path.isfile(fn)
+            with open(fn, 'a', newline='', encoding='utf-8')as f:
+                writer = csv.DictWriter(f, headers)
+                if not exist:
+                    writer.writeheader()
+                writer.writerow(dict(mid=dn['mid'], aid=dn['aid'], cid=dn['cid'], title=dn['title'], url=dn['url']))
+            print('failed topic saved in {}'.format(fn))
+        except Exception as e:
+            logger.error('error : failed to save topics. {}'.format(e))
+
+
+def verify_library(mids):
+    # hashes the files in the manifests of the mid folders again, of every folder having one when no mid is
+    # given, on -w:n processes. a file missing or changed is marked in its manifest and failed in the job
+    # database, -retry downloads it again
+    folders = mids or sorted(name for name in os.listdir('.') if os.path.isfile(os.path.join(name, 'manifest.jsonl')))
+    for folder in folders:
+        if not os.path.isfile(os.path.join(folder, 'manifest.jsonl')):
+            logger.warning('{} has no manifest.jsonl, nothing to verify'.format(folder))
+    folders = [folder for folder in folders if os.path.isfile(os.path.join(folder, 'manifest.jsonl'))]
+    checks = []
+    for folder in folders:
+        known = manifest.open_manifest(folder)
+        checks.extend((known, entry) for entry in list(known.entries.values()) if entry.get('status') == 'ok')
+    print('verifying {} file(s) of {} folder(s) on {} process(es) ...'.format(len(checks), len(folders),
+                                                                           settings['workers']))
+    utility.reporter.rate = settings['progress_rate']
+    utility.reporter.start()
+    db = jobs.JobDatabase()
+    counts = dict(ok=0, missing=0, size=0, hash=0, error=0)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=settings['workers']) as executor:
+        futures = dict((executor.submit(manifest.verify_file, os.path.join(os.path.dirname(known.path), entry['file']),
+                                        entry), (known, entry)) for known, entry in checks)
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            known, entry = futures[future]
+            file = os.path.join(os.path.dirname(known.path), entry['file'])
+            try:
+                status = future.result()[1]
+            except Exception as e:
+                logger.error('error : failed to verify {}. {}'.format(file, e))
+                status = 'error'
+            counts[status] += 1
+            if status in ['missing', 'size', 'hash']:
+                logger.warning('{} is {}'.format(file, 'missing' if status == 'missing' else 'changed'))
+                known.put(dict(entry, status=status, time=time.time()))
+                db.fail_file(file, 'verify : {} differs from the manifest'.format(status))
+            utility.reporter.stage('verify', done, len(checks))
+    db.close()
+    for folder in folders:
+        manifest.open_manifest(folder).compact()  # the lines replaced by later ones are dropped
+    utility.reporter.stop()
+    print('{ok} file(s) intact, {missing} missing, {size} of another size, {hash} with other content, '
+          '{error} not readable'.format(**counts))
+    if counts['missing'] + counts['size'] + counts['hash'] > 0:
+        print('run -retry to download the missing and changed files again')
+
+
+def run(mode, keywords_file, parameters):
+    global runid, all_topics, all_files, all_downloads, cid_cache, job_db, work_queue, work_keywords
+    runid = utility.timestamp()
+    all_topics, all_files, all_downloads = jobs.JobStore(), [], jobs.JobStore()
+    metrics.reset()
+    if 'metrics_file' in settings:
+        metrics.start_exporter(settings['metrics_file'])
+    utility.reporter.rate = settings['progress_rate']
+    utility.reporter.start()
+
+    keywords = []
+    if mode == 'worker':
+        if 'queue' not in settings:
+            logger.error('-worker needs the queue file of the coordinator, -q:file')
+            return
+        work_queue = workqueue.WorkQueue(settings['queue'])
+        while work_queue.get('settings') is None:  # the coordinator has not started yet
+            time.sleep(1)
+        settings.update(work_queue.get('settings'))  # every worker runs with the coordinator settings
+        keywords = work_queue.get('keywords')
+    elif keywords_file is not None:
+        keywords = load_keywords(keywords_file)
+        if keywords is not None:
+            print('keywords={}'.format(keywords))
+    keywords = utility.compile_keywords(keywords)  # matched by one automaton instead of word by word
+    utility.set_log_format(settings.get('log_format', 'text'))
+    downloader.block_size = settings['block_size'] * 1024
+    downloader.sync_size = settings.get('sync_size', 0) * 1024 * 1024
+
+    # every worker of the widest stage keeps its connection alive
+    utility.configure_session(max(settings['page_workers'], settings['cid_workers'],
+                                  settings['download_workers'] * settings['segments']))
+    # the api hosts start from -r:n request/s, and adapt to how they answer. the workers sharing an address
+    # split it, the coordinator of -q keeps the rate of its own crawls
+    utility.set_rate_limit(settings['rate'], max(settings['page_workers'], settings['cid_workers']),
+                           share=settings.get('rate_share', 1))
+
+    # the processes of a -q:file run share the cache, a pending batch would lock the others out
+    cid_cache = cache.CidCache(batch=1 if 'queue' in settings else 100)
+    if 'cache_invalidate' in settings:
+        invalidate = settings['cache_invalidate']
+        if invalidate.lower() == 'all':
+            cnt = cid_cache.invalidate()
+        else:
+            cnt = cid_cache.invalidate([aid.strip() for aid in invalidate.split(',') if len(aid.strip()) > 0])
+        print('{} cid cache entries invalidated'.format(cnt))
+
     try:
-        headers = ['mid', 'aid', 'cid', 'title', 'url']
-        fn = '{0}.csv'.format(runid)
-        print('saving failed topic to {} ...'.format(fn))
-        exist = os.path.isfile(fn)
-        with open(fn, 'a', newline='', encoding='utf-8')as f:
-            writer = csv.DictWriter(f, headers)
-            if not exist:
-                writer.writeheader()
-            writer.writerow(dict(mid=dn['mid'], aid=dn['aid'], cid=dn['cid'], title=dn['title'], url=dn['url']))
-        print('failed topic saved in {}'.format(fn))
-    except Exception as e:
-        logger.error('error : failed to save topics. {}'.format(e))
+        if mode == 'worker':
+            work_keywords = keywords
+            work(work_queue)
+        else:
+            job_db = jobs.JobDatabase()
+            processes = []
+            topics = None
+            try:
+                if 'queue' in settings:
+                    # the coordinator of the worker processes, an interrupted run of the queue is resumed
+                    work_queue = workqueue.WorkQueue(settings['queue'])
+                    if work_queue.get('closed', True):
+                        work_queue.clear()
+                    work_queue.set('closed', False)
+                    collected[:] = [0, 0, 0]
+                    work_queue.set('keywords', keywords.words)
+                    shared = list(setting_options.values()) + ['incremental', 'log_format', 'sync_size', 'merge']
+                    work_queue.set('settings', dict((name, settings[name]) for name in shared if name in settings))
+                    processes = start_workers(settings['workers'])
+                    print('{} local worker(s) started on {}'.format(len(processes), settings['queue']))
+
+                if mode in ['od', 'uod', 'retry', 'watch'] and work_queue is None:
+                    start_downloads(settings['download_workers'])
+                if mode in ['uo', 'uod']:
+                    topics = load_topics(parameters, keywords) if work_queue is None else coordinate_topics(parameters)
+                elif mode == 'retry':
+                    topics = load_failed(parameters)
+                elif mode == 'watch':
+                    settings['incremental'] = True
+                    topics = watch_topics(parameters, keywords)
+                else:
+                    topics = load_outputs(parameters, keywords)
+                for topic in topics:  # the topics are saved and downloaded while the next ones are loaded
+                    job_db.put_topic(topic)
+                    if mode in ['od', 'uod', 'retry', 'watch']:
+                        if work_queue is None:
+                            add_topic(topic, settings['download_workers'])
+                        else:
+                            queue_download(topic)
+
+                stats = cid_cache.stats()
+                metrics.count('cid_cache_hits', stats['hits'])
+                print('cid cache : {} hit(s), {} miss(es), {} entries'.format(stats['hits'], stats['misses'],
+                                                                           stats['entries']))
+
+                if work_queue is not None:
+                    work_queue.set('closed', True)  # the workers leave once nothing is left
+                    if mode in ['od', 'uod', 'retry', 'watch']:
+                        finish_queued_downloads()
+                    for process in processes:
+                        process.wait()
+                elif mode in ['od', 'uod', 'retry', 'watch']:
+                    finish_downloads(settings['download_workers'])
+            except KeyboardInterrupt:
+                # the loaded topics and the finished downloads are committed, the rest is resumed by the next run
+                if topics is not None and hasattr(topics, 'close'):
+                    topics.close()
+                if mode in ['od', 'uod', 'retry', 'watch'] and work_queue is None and download_engine is not None:
+                    stop_downloads()
+                else:
+                    print('\ninterrupted')
+            finally:
+                topic_states, download_states = job_db.stats()
+                print('job database : topics {}, downloads {}'.format(topic_states, download_states))
+                job_db.close()
+                job_db = None
+    finally:
+        cid_cache.close()
+        if work_queue is not None:
+            work_queue.close()
+            work_queue = None
+    utility.reporter.stop()
+
+    for host, limits in utility.get_rate_limits().items():
+        print('{} : {rate} request/s, {concurrency} connection(s), {requests} request(s), {errors} error(s), '
+              '{throttled} throttled'.format(host, **limits))
+
+    metrics.stop_exporter()
+    summary = metrics.summary()
+    for name, phase in summary['phases'].items():
+        print('{} : {wall:.2f}s, {seconds:.2f}s in {count} call(s)'.format(name, **phase))
+    for host, latency in summary['latency'].items():
+        print('{} : {count} request(s), {average:.3f}s average, p90 {p90}s, p99 {p99}s'.format(host, **latency))
+    if summary['download']['bytes'] > 0:
+        print('downloaded : {:.1f} MB at {:.1f} MB/s'.format(summary['download']['bytes'] / 1024 / 1024,
+                                                         summary['download']['bytes_per_second'] / 1024 / 1024))
+    print('metrics saved in {}'.format(metrics.save_summary('{}_metrics.json'.format(runid))))
 
 
 if __name__ == '__main__':
-    runid = utility.timestamp()
     md, kw, params = parse_command_line()
     if md is None:
         exit(-1)
     if md == 'h':
         if os.path.isfile('help.txt'):
-            if 'Darwin' in platform.system():
-                os.system('cat help.txt')
-            if 'Windows' in platform.system():
-                os.system('type help.txt')
+            with open('help.txt', 'r', encoding='utf-8') as f:
+                print(f.read())
         exit(0)
 
-    all_topics, all_files, all_downloads = [], [], []
-
-    startupinfo = subprocess.STARTUPINFO()
-    startupinfo.dwFlags = subprocess.STARTF_USESHOWWINDOW
-    startupinfo.wShowWindow = subprocess.SW_HIDE
-
-    keywords = []
-    if kw is not None:
-        keywords = load_keywords(kw)
-        if keywords is not None:
-            print('keywords={}'.format(keywords))
-
-    if md == 'uo':
-        all_topics = load_topics(params, keywords)
-        all_files = save_outputs(all_topics)
-    if md == 'od':
-        all_topics = load_outputs(params, keywords)
-        process_download()
-    if md == 'uod':
-        all_topics = load_topics(params, keywords)
-        all_files = save_outputs(all_topics)
-        process_download()
+    if md == 'verify':
+        verify_library(params)
+    else:
+        run(md, kw, params)
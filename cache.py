@@ -0,0 +1,72 @@
+import time
+import sqlite3
+import threading
+
+import utility
+
+logger = utility.log('cache')
+
+
+class CidCache:
+    # aid -> cid never changes, so it is kept on disk and shared by every run and mode
+    def __init__(self, path='cid_cache.db', batch=100):
+        self.path = path
+        self.batch = batch  # commit every n puts
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)  # may be shared by processes
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cids (aid TEXT PRIMARY KEY, cid TEXT NOT NULL, updated REAL)')
+        self.db.commit()
+        logger.debug('cid cache {} opened'.format(path))
+
+    def get(self, aid):
+        with self.lock:
+            row = self.db.execute('SELECT cid FROM cids WHERE aid = ?', (str(aid),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, aid, cid):
+        cid = str(cid).strip()
+        if len(cid) == 0:
+            return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cids (aid, cid, updated) VALUES (?, ?, ?)',
+                            (str(aid), cid, time.time()))
+            self.pending += 1
+            if self.pending >= self.batch:
+                self.db.commit()
+                self.pending = 0
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def invalidate(self, aids=None):
+        # drop the given aids, or every entry when aids is None
+        with self.lock:
+            if aids is None:
+                cursor = self.db.execute('DELETE FROM cids')
+            else:
+                cursor = self.db.executemany('DELETE FROM cids WHERE aid = ?', [(str(aid),) for aid in aids])
+            self.db.commit()
+            self.pending = 0
+            logger.debug('{} cid cache entries invalidated'.format(cursor.rowcount))
+            return cursor.rowcount
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM cids').fetchone()[0]
+            return dict(hits=self.hits, misses=self.misses, entries=entries)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -1,11 +1,357 @@
+import re
 import sys
+import json
+import time
 import base64
 import os
+import threading
+import concurrent.futures
 
+import metrics
 import utility
+import manifest
 
 logger = utility.log('download')
 
+block_size = 256 * 1024  # bytes read and written at once, -bs:n of bilibili.py
+sync_size = 0  # fsync a file every that many bytes and before its rename, 0 leaves it to the os
+checkpoint_size = 16 * 1024 * 1024  # how often the progress of a segment is saved when sync_size is 0
+buffers = threading.local()  # the reusable read buffer of every downloading thread
+
+
+class LengthChangedError(Exception):
+    pass
+
+
+def get_download_headers():
+    headers = utility.get_generic_request_headers()
+    headers['Upgrade-Insecure-Requests'] = '1'
+    headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8'
+    headers['Accept-Encoding'] = 'gzip, deflate'
+    headers['Accept-Language'] = 'en-US,en;q=0.9'
+    return headers
+
+
+def parse_content_range(value):
+    # 'bytes 100-199/1000' -> (100, 199, 1000), None when it can not be parsed
+    match = re.match(r'\s*bytes\s+(\d+)-(\d+)/(\d+)', value or '')
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+
+def request_download(url, partial):
+    # requests the bytes after the partial file, falls back to the whole file when the server
+    # does not answer the range. returns (response, offset the response starts from, total length)
+    if partial > 0:
+        headers = get_download_headers()
+        headers['Range'] = 'bytes={}-'.format(partial)
+        res = utility.request_url(url, headers, decode=False)
+        if res is not None:
+            if res.status == 206:
+                content_range = parse_content_range(res.getheader('Content-Range'))
+                length = res.getheader('content-length')
+                if content_range is not None and content_range[0] == partial and \
+                        (not length or int(length) == content_range[2] - partial):
+                    return res, partial, content_range[2]
+                logger.debug('unexpected range {} for {} bytes of {}'.format(res.getheader('Content-Range'),
+                                                                             partial, url))
+                res.close()
+            else:
+                length = res.getheader('content-length')
+                logger.debug('range is ignored by the server, download {} again'.format(url))
+                return res, 0, int(length) if length else None
+    res = utility.request_url(url, get_download_headers(), decode=False)
+    if res is None:
+        return None, 0, None
+    length = res.getheader('content-length')
+    return res, 0, int(length) if length else None
+
+
+def get_buffer():
+    # a memoryview of block_size bytes the responses are read into, allocated once per thread
+    view = getattr(buffers, 'view', None)
+    if view is None or len(view) != block_size:
+        view = buffers.view = memoryview(bytearray(block_size))
+    return view
+
+
+def preallocate(fd, length):
+    # the file gets its final length at once, its blocks reserved by posix_fallocate where there is one
+    if os.fstat(fd).st_size == length:
+        return
+    os.ftruncate(fd, length)
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except OSError as e:
+            logger.debug('unable to preallocate %s bytes. %s', length, e)
+
+
+def split_segments(length, segments, min_segment_size):
+    # [start, end, done] byte ranges, fewer segments when the file is small
+    count = max(1, min(segments, length // max(min_segment_size, 1)))
+    step = length // count
+    return [[i * step, (i + 1) * step - 1 if i < count - 1 else length - 1, False] for i in range(count)]
+
+
+def load_segments(state_file):
+    # the segments of an interrupted segmented download, None when there is nothing to resume
+    if not os.path.isfile(state_file):
+        return None
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning('unable to load segments from {}. {}'.format(state_file, e))
+        return None
+
+
+def save_segments(state_file, state):
+    with open(state_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def fetch_segment(url, fd, segment, length, res=None, count=None, checkpoint=None, retries=3):
+    # writes bytes segment[0]..segment[1] in place with positional writes, a failed attempt is retried
+    # from the last written byte of the segment only. the bytes are hashed while they are written, a piece
+    # [start, end, hash] at a time. checkpoint(position, piece) saves the progress every sync_size bytes
+    # after an fsync, or every checkpoint_size bytes without. returns the last piece
+    position, end = segment[0], segment[1]
+    view = get_buffer()
+    interval = sync_size or checkpoint_size
+    saved = position
+    digest = manifest.new_hash()
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(utility.backoff(attempt - 1))
+        try:
+            if res is None:
+                headers = get_download_headers()
+                headers['Range'] = 'bytes={}-{}'.format(position, end)
+                res = utility.request_url(url, headers, decode=False)
+                if res is None:
+                    raise Exception('failed to request {}'.format(url))
+                content_range = parse_content_range(res.getheader('Content-Range'))
+                if content_range is not None and content_range[2] != length:
+                    raise LengthChangedError('length of {} changed from {} to {}'.format(url, length,
+                                                                                        content_range[2]))
+                if res.status != 206 or content_range != (position, end, length):
+                    raise Exception('unexpected range {} for {}-{}/{}'.format(res.getheader('Content-Range'),
+                                                                             position, end, length))
+            while position <= end:
+                size = res.readinto(view[:min(block_size, end + 1 - position)])
+                if not size:
+                    raise Exception('connection closed at {} of segment {}-{}'.format(position, segment[0], end))
+                os.pwrite(fd, view[:size], position)
+                digest.update(view[:size])
+                position += size
+                if count is not None:
+                    count(size)
+                if checkpoint is not None and position - saved >= interval and position <= end:
+                    if sync_size > 0:
+                        os.fsync(fd)
+                    checkpoint(position, [saved, position - 1, digest.hexdigest()])
+                    saved = position
+                    digest = manifest.new_hash()
+            res.close()
+            return [saved, end, digest.hexdigest()]
+        except Exception as e:
+            logger.debug('segment %s-%s of %s failed at %s, attempt %s. %s', segment[0], end, url, position,
+                         attempt + 1, e)
+            metrics.count('segment_retries' if attempt < retries else 'segment_failures')
+            if res is not None:
+                res.close()
+                res = None
+            if isinstance(e, LengthChangedError):
+                raise
+    raise Exception('failed to download segment {}-{} of {}'.format(segment[0], end, url))
+
+
+def download_segments(url, dn_file, state_file, state, res=None):
+    # downloads the segments not done yet on parallel connections into the preallocated dn_file,
+    # res is the response of the whole file, reused by the first segment. the hashed pieces are added
+    # to state['pieces']. the state file is kept until dn_file is renamed. returns the bytes transferred
+    length = state['length']
+    pieces = state.setdefault('pieces', [])
+    lock = threading.Lock()
+    transferred = [0]
+    utility.reporter.begin(dn_file, length, length - sum(segment[1] + 1 - segment[0] for segment in state['segments']
+                                                         if not segment[2]))
+
+    def count(size):
+        metrics.count('download_bytes', size)
+        with lock:
+            transferred[0] += size
+            utility.reporter.advance(dn_file, size)
+
+    def run(segment, first):
+        def checkpoint(position, piece):
+            with lock:
+                segment[0] = position  # resumed from there
+                pieces.append(piece)
+                save_segments(state_file, state)
+
+        piece = fetch_segment(url, fd, segment, length, first, count, checkpoint)
+        with lock:
+            segment[2] = True
+            pieces.append(piece)
+            save_segments(state_file, state)
+
+    todo = [segment for segment in state['segments'] if not segment[2]]
+    save_segments(state_file, state)  # before the file is preallocated, its length tells nothing about its bytes
+    fd = os.open(dn_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        preallocate(fd, length)
+        errors = []
+        if len(todo) == 1:  # one connection, no thread of its own
+            first = res if todo[0][0] == 0 else None
+            if first is not None:
+                res = None
+            try:
+                run(todo[0], first)
+            except Exception as e:
+                errors.append(e)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(todo), 1)) as executor:
+                futures = []
+                for segment in todo:
+                    first = res if segment[0] == 0 else None
+                    if first is not None:
+                        res = None
+                    futures.append(executor.submit(run, segment, first))
+                errors = [future.exception() for future in futures if future.exception() is not None]
+        if len(errors) == 0 and sync_size > 0:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+        if res is not None:
+            res.close()
+    changed = [error for error in errors if isinstance(error, LengthChangedError)]
+    if len(changed) > 0:
+        # the written segments belong to another file, start again next time
+        for fn in [dn_file, state_file]:
+            if os.path.isfile(fn):
+                os.remove(fn)
+        raise changed[0]
+    if len(errors) > 0:
+        raise errors[0]
+    return transferred[0]
+
+
+def download(url, folder, title, index, segments=1, min_segment_size=4 * 1024 * 1024):
+    # download one durl segment to <folder>/<title>-<index>.flv, on up to segments connections
+    # returns dict(status=completed|skipped|failed, file, size=bytes transferred, length, error)
+    title = utility.validated_file_name(title)
+
+    file = '{}-{}.flv'.format(title, index)
+    dn_file = 'downloading_{}'.format(file)
+
+    file = os.path.join(folder, file)
+    dn_file = os.path.join(folder, dn_file)
+    state_file = '{}.segments'.format(dn_file)
+
+    result = dict(status='failed', file=file, size=0, length=None, error=None)
+    try:
+        # a file the manifest knows is skipped without asking the server
+        known = manifest.open_manifest(folder)
+        entry = known.get(os.path.basename(file))
+        if entry is not None and known.is_intact(os.path.basename(file), file):
+            logger.debug('%s is intact according to the manifest. do not download again', file)
+            result.update(status='skipped', length=entry['size'])
+            return result
+
+        os.makedirs(folder, exist_ok=True)
+        partial = os.path.getsize(dn_file) if os.path.isfile(dn_file) else 0
+        state = load_segments(state_file) if partial > 0 else None
+        if state is not None:
+            # an interrupted segmented download, the segments tell what is left
+            res, offset, length = None, 0, state['length']
+        else:
+            res, offset, length = request_download(url, partial)
+            if res is None:
+                raise Exception('failed to request {}'.format(url))
+
+        if not length:
+            res.close()
+            raise Exception('unable to get length of video')
+        result['length'] = length
+
+        if entry is None and os.path.isfile(file):  # downloaded before the manifest, only the size can tell
+            if os.path.getsize(file) == length:
+                if res is not None:
+                    res.close()
+                logger.debug('same file %s and same size exist. do not download again', file)
+                result['status'] = 'skipped'
+                try:
+                    manifest.record(folder, file, url, [], length)  # skipped without asking the server from now on
+                except Exception as e:
+                    logger.warning('unable to add {} to the manifest. {}'.format(file, e))
+                return result
+
+        # a server answering ranges gets a preallocated file written in place, resumable by its segments
+        # even on one connection. anything else is appended to
+        if state is None and offset == 0 and partial == 0 and hasattr(os, 'pwrite') and \
+                (res.getheader('Accept-Ranges') or '').lower() == 'bytes':
+            state = dict(length=length, segments=split_segments(length, segments, min_segment_size))
+
+        pieces = []
+        if state is not None:
+            logger.debug('download %s in %s segments', dn_file, len(state['segments']))
+            result['size'] = download_segments(url, dn_file, state_file, state, res)
+            pieces = state['pieces']
+        elif offset == 0 and partial == length and not os.path.isfile(state_file):
+            # appended completely by the last attempt, but not renamed yet. a preallocated file has the
+            # length from the start, it is trusted by its segments only
+            res.close()
+        else:
+            if offset > 0:
+                logger.debug('resume %s from %s of %s bytes', dn_file, offset, length)
+            utility.reporter.begin(dn_file, length, offset)
+            view = get_buffer()
+            digest = manifest.new_hash()
+            with open(dn_file, "ab" if offset > 0 else "wb", buffering=0) as f:
+                size = offset
+                synced = offset
+                while True:
+                    received = res.readinto(view)
+                    if not received:
+                        if size == length:
+                            break
+                        else:
+                            raise Exception('{} downloaded size is not same as expected length.'.format(dn_file))
+                    f.write(view[:received])
+                    digest.update(view[:received])
+                    size += received
+                    metrics.count('download_bytes', received)
+                    result['size'] = size - offset
+                    utility.reporter.advance(dn_file, received)
+                    if sync_size > 0 and size - synced >= sync_size:
+                        os.fsync(f.fileno())
+                        synced = size
+                if sync_size > 0:
+                    os.fsync(f.fileno())
+            pieces = [[offset, length - 1, digest.hexdigest()]]  # the resumed bytes before offset are hashed later
+
+        if os.path.isfile(file):
+            os.remove(file)
+        os.rename(dn_file, file)
+        if os.path.isfile(state_file):
+            os.remove(state_file)
+        result['status'] = 'completed'
+        try:
+            manifest.record(folder, file, url, pieces, length)
+        except Exception as e:
+            logger.warning('unable to add {} to the manifest. {}'.format(file, e))
+    except Exception as e:
+        logger.error('fatal error : {}'.format(e))
+        result['error'] = str(e)
+    finally:
+        utility.reporter.end(dn_file)
+    return result
+
+
 if __name__ == '__main__':
     if len(sys.argv) != 5:
         print('Welcome to download.py')
@@ -21,57 +367,16 @@ if __name__ == '__main__':
 
             title = base64.urlsafe_b64decode(title).decode('utf-8')
             url = base64.urlsafe_b64decode(url).decode('utf-8')
-
-            title = utility.validated_file_name(title)
-
-            file = '{}-{}.flv'.format(title, index)
-            dn_file = 'downloading_{}'.format(file)
-
-            file = '{}\\{}'.format(folder, file)
-            dn_file = '{}\\{}'.format(folder, dn_file)
-
-            headers = utility.get_generic_request_headers()
-            headers['Host'] = 'cn-jlcc-gd-acache-02.acgvideo.com'
-            headers['Upgrade-Insecure-Requests'] = '1'
-            headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8'
-            headers['Accept-Encoding'] = 'gzip, deflate'
-            headers['Accept-Language'] = 'en-US,en;q=0.9'
-
-            res = utility.request_url(url, headers)
-
-            length = res.getheader('content-length')
-            if length:
-                length = int(length)
-
-                if os.path.isfile(file):
-                    if os.path.getsize(file) == length:
-                        logger.debug('same file {} and same size exist. do not download again'.format(file))
-                        print('file {} already exist, cancel download.'.format(file))
-                        exit(0)
-
-                block_size = 1024 * 16
-                utility.progress_bar(0, length, prefix='Progress:', suffix='Complete', length=50)
-                with open(dn_file, "wb") as f:
-                    size = 0
-                    while True:
-                        data = res.read(block_size)
-                        if not data:
-                            if size == length:
-                                break
-                            else:
-                                raise Exception('{} downloaded size is not same as expected length.'.format(dn_file))
-                        f.write(data)
-                        size += len(data)
-                        if length:
-                            utility.progress_bar(size, length, prefix='Progress:', suffix='Complete', length=50)
-
-                if os.path.isfile(file):
-                    os.remove(file)
-                os.rename(dn_file, file)
-                print('downloaded')
-            else:
-                logger.error('fatal error : unable to get length of video')
-                exit(-1)
         except Exception as e:
             logger.error('fatal error : {}'.format(e))
             exit(-1)
+
+        utility.reporter.start()
+        downloaded = download(url, folder, title, index)
+        utility.reporter.stop()
+        if downloaded['status'] == 'skipped':
+            print('file {} already exist, cancel download.'.format(downloaded['file']))
+        elif downloaded['status'] == 'completed':
+            print('downloaded')
+        else:
+            exit(-1)
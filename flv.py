@@ -0,0 +1,164 @@
+import os
+import mmap
+import struct
+
+import utility
+
+logger = utility.log('flv')
+
+copy_methods = ['copy_file_range', 'sendfile', 'write']  # tried in that order, the ones failing are dropped
+
+
+class FlvError(Exception):
+    pass
+
+
+def read_header(mm):
+    # the size of the flv header, the first tag starts after it and the 4 bytes of the previous tag size 0
+    if len(mm) < 13 or mm[:3] != b'FLV':
+        raise FlvError('not a flv file')
+    return int.from_bytes(mm[5:9], 'big')
+
+
+def read_tags(mm, position):
+    # (position, type, data size, timestamp) of every complete tag from position on
+    while position + 15 <= len(mm):
+        size = int.from_bytes(mm[position + 1:position + 4], 'big')
+        if position + 11 + size + 4 > len(mm):
+            break  # cut at the end
+        timestamp = int.from_bytes(mm[position + 4:position + 7], 'big') | mm[position + 7] << 24
+        yield position, mm[position] & 0x1f, size, timestamp
+        position += 11 + size + 4
+
+
+def is_sequence_header(mm, position, tag_type, size):
+    # the avc or aac configuration a decoder needs once, repeated at the start of every part
+    if size < 2:
+        return False
+    first, second = mm[position + 11], mm[position + 12]
+    if tag_type == 9:
+        return first & 0x0f == 7 and second == 0
+    if tag_type == 8:
+        return first >> 4 == 10 and second == 0
+    return False
+
+
+def copy_range(src, dst, src_offset, dst_offset, count):
+    # moves count bytes from src to dst in the kernel, through a buffer only where it has no way to
+    while count > 0:
+        method = copy_methods[0]
+        try:
+            if method == 'copy_file_range':
+                copied = os.copy_file_range(src, dst, count, src_offset, dst_offset)
+            elif method == 'sendfile':
+                os.lseek(dst, dst_offset, os.SEEK_SET)
+                copied = os.sendfile(dst, src, src_offset, count)
+            else:
+                os.lseek(src, src_offset, os.SEEK_SET)
+                os.lseek(dst, dst_offset, os.SEEK_SET)
+                copied = os.write(dst, os.read(src, min(count, 1024 * 1024)))
+        except (AttributeError, OSError) as e:
+            if method == 'write':
+                raise
+            logger.debug('%s is not available, falling back. %s', method, e)
+            copy_methods.remove(method)
+            continue
+        if copied == 0:
+            raise FlvError('unexpected end of file at {}'.format(src_offset))
+        src_offset += copied
+        dst_offset += copied
+        count -= copied
+
+
+def write_at(fd, data, position):
+    # a positional write, through lseek where there is no pwrite (windows)
+    if hasattr(os, 'pwrite'):
+        os.pwrite(fd, data, position)
+    else:
+        os.lseek(fd, position, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def patch_number(fd, data, position, name, value):
+    # overwrites the amf number of name in the onMetaData data written at position, when it has one
+    key = len(name).to_bytes(2, 'big') + name.encode('ascii') + b'\x00'
+    index = data.find(key)
+    if index >= 0 and index + len(key) + 8 <= len(data):
+        write_at(fd, struct.pack('>d', value), position + index + len(key))
+
+
+def merge(parts, output):
+    # joins the flv parts into output. the header and the metadata of the first part are kept, the metadata and
+    # the repeated sequence headers of the next parts are dropped and their timestamps go on from the end of the
+    # previous part. only the rewritten tag headers are written from here, the payloads are copied between the
+    # files by the kernel. written to merging_<name> first and renamed, removed when the merge failed.
+    # returns the size of output
+    temp = os.path.join(os.path.dirname(output), 'merging_{}'.format(os.path.basename(output)))
+    dst = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    completed = False
+    try:
+        written = 0
+        offset = 0  # added to the timestamps of the part
+        last = 0  # the latest timestamp written
+        interval = 40  # between the last two video frames, the gap left between two parts
+        seen = set()  # sequence headers written already
+        meta = None  # (position, data) of the onMetaData tag in output
+        for n, part in enumerate(parts):
+            src = os.open(part, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                with mmap.mmap(src, 0, access=mmap.ACCESS_READ) as mm:
+                    header_size = read_header(mm)
+                    if n == 0:
+                        write_at(dst, mm[:header_size] + b'\x00\x00\x00\x00', 0)
+                        written = header_size + 4
+                    first = None
+                    previous = None  # the last video timestamp of the part
+                    run = None  # [src position, dst position, size] of unchanged bytes copied at once
+                    for position, tag_type, size, timestamp in read_tags(mm, header_size + 4):
+                        if tag_type == 18 and n > 0:
+                            continue
+                        if is_sequence_header(mm, position, tag_type, size):
+                            config = bytes(mm[position + 11:position + 11 + size])
+                            if (tag_type, config) in seen:
+                                continue
+                            seen.add((tag_type, config))
+                        if tag_type == 18 and meta is None:
+                            meta = (written + 11, bytes(mm[position + 11:position + 11 + size]))
+                        if first is None:
+                            first = 0 if n == 0 else timestamp
+                        adjusted = max(timestamp - first + offset, 0)
+                        if tag_type == 9:
+                            if previous is not None and timestamp > previous:
+                                interval = timestamp - previous
+                            previous = timestamp
+                        last = max(last, adjusted)
+                        header = bytes(mm[position:position + 4]) + (adjusted & 0xffffff).to_bytes(3, 'big') + \
+                            bytes([adjusted >> 24 & 0xff]) + b'\x00\x00\x00'
+                        if header == mm[position:position + 11] and run is not None and \
+                                run[0] + run[2] == position:
+                            run[2] += 11 + size + 4
+                        elif header == mm[position:position + 11]:
+                            if run is not None:
+                                copy_range(src, dst, run[0], run[1], run[2])
+                            run = [position, written, 11 + size + 4]
+                        else:
+                            if run is not None:
+                                copy_range(src, dst, run[0], run[1], run[2])
+                            write_at(dst, header, written)
+                            run = [position + 11, written + 11, size + 4]
+                        written += 11 + size + 4
+                    if run is not None:
+                        copy_range(src, dst, run[0], run[1], run[2])
+            finally:
+                os.close(src)
+            offset = last + interval
+        if meta is not None:
+            patch_number(dst, meta[1], meta[0], 'duration', last / 1000.0)
+            patch_number(dst, meta[1], meta[0], 'filesize', float(written))
+        completed = True
+    finally:
+        os.close(dst)
+        if not completed:
+            os.remove(temp)
+    os.replace(temp, output)
+    return written
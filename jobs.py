@@ -0,0 +1,208 @@
+import os
+import enum
+import time
+import sqlite3
+import threading
+import collections
+
+import utility
+
+logger = utility.log('jobs')
+
+
+class Status(enum.IntEnum):
+    WAITING = 0
+    DOING = 1  # a topic is downloading once its durls are being loaded
+    COMPLETED = 2
+    FAILED = -2
+
+
+class Topic:
+    __slots__ = ('mid', 'aid', 'cid', 'title', 'url', 'status', 'remains', 'parts')
+
+    def __init__(self, mid, aid, cid, title, url):
+        self.mid = mid
+        self.aid = aid
+        self.cid = cid
+        self.title = title
+        self.url = url
+        self.status = Status.WAITING
+        self.remains = 0  # downloads not finished yet
+        self.parts = 0  # durls of the topic, once they are loaded
+
+    def row(self):
+        return dict(mid=self.mid, aid=self.aid, cid=self.cid, title=self.title, url=self.url)
+
+
+class Download:
+    # one durl segment of a topic
+    __slots__ = ('topic', 'url', 'index', 'status', 'size', 'future', 'expires')
+
+    def __init__(self, topic, url, index):
+        self.topic = topic
+        self.url = url
+        self.index = index
+        self.status = Status.WAITING
+        self.size = 0
+        self.future = None
+        self.expires = None  # when the durl stops working, None when unknown
+
+    def row(self):
+        return dict(mid=self.topic.mid, aid=self.topic.aid, cid=self.topic.cid, title=self.topic.title, url=self.url)
+
+
+class JobStore:
+    # records indexed by status. the waiting ones are queued in arrival order and the others are kept
+    # in sets, so counting, taking the next record and moving one between statuses are all O(1)
+    def __init__(self):
+        self.size = 0
+        self.waiting = collections.deque()
+        self.index = dict((status, set()) for status in Status if status != Status.WAITING)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        yield from self.waiting
+        for records in self.index.values():
+            yield from records
+
+    def add(self, record):
+        record.status = Status.WAITING
+        self.waiting.append(record)
+        self.size += 1
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def pop(self):
+        # the next waiting record, None when there is none. it is moved by set_status right after
+        return self.waiting.popleft() if len(self.waiting) > 0 else None
+
+    def retake(self, record):
+        # a record taken by pop goes back to the head of the waiting queue
+        self.waiting.appendleft(record)
+
+    def set_status(self, record, status):
+        if record.status != Status.WAITING:  # a waiting one was taken off the queue by pop
+            self.index[record.status].discard(record)
+        record.status = status
+        if status == Status.WAITING:
+            self.waiting.append(record)
+        else:
+            self.index[status].add(record)
+
+    def clear(self, status):
+        # forgets the records of a status other than waiting
+        self.size -= len(self.index[status])
+        self.index[status].clear()
+
+    def count(self, status):
+        return len(self.waiting) if status == Status.WAITING else len(self.index[status])
+
+    def records(self, status):
+        return iter(self.waiting) if status == Status.WAITING else iter(self.index[status])
+
+
+class JobDatabase:
+    # the state of every topic and download on disk, an interrupted run is resumed and the failed work
+    # is retried without repeating what completed. the writes are committed in batches
+    def __init__(self, path='jobs.db', batch=100):
+        self.path = path
+        self.batch = batch  # commit every n writes
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS topics (aid TEXT PRIMARY KEY, mid TEXT NOT NULL, cid TEXT, '
+                        'title TEXT, url TEXT, status INTEGER NOT NULL, updated REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS topics_mid ON topics (mid, status)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS downloads (aid TEXT NOT NULL, idx INTEGER NOT NULL, url TEXT, '
+                        'file TEXT, size INTEGER, status INTEGER NOT NULL, error TEXT, updated REAL, '
+                        'PRIMARY KEY (aid, idx))')
+        self.db.commit()
+        logger.debug('job database {} opened'.format(path))
+
+    def write(self, sql, parameters):
+        with self.lock:
+            self.db.execute(sql, parameters)
+            self.pending += 1
+            if self.pending >= self.batch:
+                self.db.commit()
+                self.pending = 0
+
+    def put_topic(self, topic, status=Status.WAITING):
+        # topic is a row of mid, aid, cid, title, url. a completed topic stays completed
+        self.write('INSERT INTO topics (aid, mid, cid, title, url, status, updated) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                   'ON CONFLICT (aid) DO UPDATE SET mid = excluded.mid, cid = excluded.cid, title = excluded.title, '
+                   'url = excluded.url, updated = excluded.updated, status = CASE WHEN status = {} THEN status '
+                   'ELSE excluded.status END'.format(int(Status.COMPLETED)),
+                   (str(topic['aid']), str(topic['mid']), str(topic['cid'] or ''), topic['title'], topic['url'],
+                    int(status), time.time()))
+
+    def set_topic_status(self, aid, status):
+        self.write('UPDATE topics SET status = ?, updated = ? WHERE aid = ?', (int(status), time.time(), str(aid)))
+
+    def put_download(self, download, status, file=None, error=None):
+        self.write('INSERT OR REPLACE INTO downloads (aid, idx, url, file, size, status, error, updated) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   (str(download.topic.aid), download.index, download.url, file, download.size, int(status),
+                    None if error is None else str(error), time.time()))
+
+    def completed_files(self, aid):
+        # index -> file of the completed downloads of a topic whose file is still there
+        with self.lock:
+            rows = self.db.execute('SELECT idx, file FROM downloads WHERE aid = ? AND status = ?',
+                                   (str(aid), int(Status.COMPLETED))).fetchall()
+        return dict((idx, file) for idx, file in rows if file and os.path.isfile(file))
+
+    def is_completed(self, aid):
+        # completed by an earlier run, and none of its files is gone since
+        with self.lock:
+            row = self.db.execute('SELECT status FROM topics WHERE aid = ?', (str(aid),)).fetchone()
+            if row is None or row[0] != Status.COMPLETED:
+                return False
+            files = self.db.execute('SELECT file FROM downloads WHERE aid = ?', (str(aid),)).fetchall()
+        return len(files) > 0 and all(file and os.path.isfile(file) for file, in files)
+
+    def fail_file(self, file, error):
+        # a completed download whose file went missing or changed, its topic is downloaded again by -retry
+        with self.lock:
+            rows = self.db.execute('SELECT aid FROM downloads WHERE file = ?', (file,)).fetchall()
+            self.db.execute('UPDATE downloads SET status = ?, error = ?, updated = ? WHERE file = ?',
+                            (int(Status.FAILED), error, time.time(), file))
+            self.db.executemany('UPDATE topics SET status = ?, updated = ? WHERE aid = ?',
+                                [(int(Status.FAILED), time.time(), aid) for aid, in rows])
+            self.db.commit()
+            self.pending = 0
+        return len(rows) > 0
+
+    def failed_topics(self, mids=None):
+        # the rows of the failed topics, of the given mids only when mids is not empty
+        sql = 'SELECT mid, aid, cid, title, url FROM topics WHERE status = ?'
+        parameters = [int(Status.FAILED)]
+        if mids:
+            sql += ' AND mid IN ({})'.format(', '.join('?' * len(mids)))
+            parameters.extend(str(mid) for mid in mids)
+        with self.lock:
+            rows = self.db.execute(sql + ' ORDER BY mid, rowid', parameters).fetchall()
+        return [dict(mid=mid, aid=aid, cid=cid, title=title, url=url) for mid, aid, cid, title, url in rows]
+
+    def stats(self):
+        with self.lock:
+            topics = dict(self.db.execute('SELECT status, COUNT(*) FROM topics GROUP BY status').fetchall())
+            downloads = dict(self.db.execute('SELECT status, COUNT(*) FROM downloads GROUP BY status').fetchall())
+        return (dict((status.name.lower(), topics.get(status, 0)) for status in Status),
+                dict((status.name.lower(), downloads.get(status, 0)) for status in Status))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
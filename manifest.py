@@ -0,0 +1,135 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import threading
+
+import utility
+
+logger = utility.log('manifest')
+
+hash_name = 'sha256'
+manifests = {}  # folder -> Manifest opened by this process
+manifests_lock = threading.Lock()
+
+
+class Manifest:
+    # what is known of the downloaded files of a mid folder, one json line per file appended to
+    # <folder>/manifest.jsonl, the last line of a file wins. an entry holds the size and mtime the file had
+    # when it was written, its source url and the hashes of its pieces, [start, end, hash] byte ranges
+    # hashed while they were downloaded. the -q workers append to the same file from several processes
+    def __init__(self, folder):
+        self.path = os.path.join(folder, 'manifest.jsonl')
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut by an interrupted run
+                    entries[entry['file']] = entry
+        return entries
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def put(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.entries[entry['file']] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    def compact(self):
+        # one line per file, written aside and renamed. the lines appended by other processes since the file
+        # was loaded are read again first, the ones appended while it is rewritten would be lost, so it is
+        # compacted by -verify only and not while downloading
+        with self.lock:
+            if not os.path.isfile(self.path):
+                return
+            self.entries = self.load()
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            os.replace(self.path + '.tmp', self.path)
+
+    def is_intact(self, name, file):
+        # the file is still the one written by its download, told without reading it or asking the server
+        entry = self.get(name)
+        if entry is None or entry.get('status') != 'ok':
+            return False
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+
+def open_manifest(folder):
+    with manifests_lock:
+        manifest = manifests.get(folder)
+        if manifest is None:
+            manifest = manifests[folder] = Manifest(folder)
+        return manifest
+
+
+def new_hash():
+    return hashlib.new(hash_name)
+
+
+def hash_file(file, start, end):
+    # the hash of bytes start..end of a file, read through mmap
+    digest = new_hash()
+    if end >= start:
+        with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                digest.update(view[start:end + 1])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+def complete_pieces(file, pieces, length):
+    # the pieces sorted, with the ranges no download hashed (written by an older version, or kept from an
+    # appended file that was resumed) hashed from the file
+    pieces = sorted(pieces)
+    position = 0
+    completed = []
+    for start, end, value in pieces:
+        if start > position:
+            completed.append([position, start - 1, hash_file(file, position, start - 1)])
+        completed.append([start, end, value])
+        position = end + 1
+    if position < length:
+        completed.append([position, length - 1, hash_file(file, position, length - 1)])
+    return completed
+
+
+def record(folder, file, url, pieces, length):
+    # called once the file got its final name
+    stat = os.stat(file)
+    open_manifest(folder).put(dict(file=os.path.basename(file), size=stat.st_size, mtime=stat.st_mtime_ns, url=url,
+                                   hash=hash_name, pieces=complete_pieces(file, pieces, length), status='ok',
+                                   time=time.time()))
+
+
+def verify_file(file, entry):
+    # runs in a verify process. returns (file, status) with status ok, missing, size or hash
+    if not os.path.isfile(file):
+        return file, 'missing'
+    if os.path.getsize(file) != entry['size']:
+        return file, 'size'
+    if entry.get('hash') != hash_name:
+        return file, 'ok'  # hashed by another algorithm, only the size can be told
+    for start, end, value in entry['pieces']:
+        if hash_file(file, start, end) != value:
+            return file, 'hash'
+    return file, 'ok'
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+# timings and counters of the hot paths, shared by every module of a run
+lock = threading.Lock()
+phases = {}  # name -> [count, seconds, first start, last end], seconds add up the concurrent calls
+counters = {}  # name -> value
+latencies = {}  # host -> [bucket counts..., count, sum]
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+started = time.time()
+exporter = None
+
+
+def reset():
+    global started
+    with lock:
+        phases.clear()
+        counters.clear()
+        latencies.clear()
+        started = time.time()
+
+
+@contextlib.contextmanager
+def phase(name):
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, began, time.perf_counter())
+
+
+def add_phase(name, began, ended):
+    with lock:
+        value = phases.get(name)
+        if value is None:
+            value = phases[name] = [0, 0.0, began, ended]
+        value[0] += 1
+        value[1] += ended - began
+        value[2] = min(value[2], began)
+        value[3] = max(value[3], ended)
+
+
+def count(name, value=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def value(name):
+    with lock:
+        return counters.get(name, 0)
+
+
+def observe(host, seconds):
+    # request latency of a host, until the response headers are received
+    with lock:
+        value = latencies.get(host)
+        if value is None:
+            value = latencies[host] = [0] * (len(latency_buckets) + 2)
+        for i, bound in enumerate(latency_buckets):
+            if seconds <= bound:
+                value[i] += 1
+                break
+        value[-2] += 1
+        value[-1] += seconds
+
+
+def percentile(value, fraction):
+    # upper bound of the bucket holding the fraction of the requests
+    total = value[-2]
+    if total == 0:
+        return 0.0
+    seen = 0
+    for i, bound in enumerate(latency_buckets):
+        seen += value[i]
+        if seen >= total * fraction:
+            return bound
+    return float('inf')
+
+
+def summary():
+    with lock:
+        elapsed = time.time() - started
+        download = phases['download'][3] - phases['download'][2] if 'download' in phases else 0.0
+        transferred = counters.get('download_bytes', 0)
+        return dict(
+            started=started,
+            seconds=round(elapsed, 3),
+            phases=dict((name, dict(count=v[0], seconds=round(v[1], 3), wall=round(v[3] - v[2], 3)))
+                        for name, v in phases.items()),
+            counters=dict(counters),
+            latency=dict((host, dict(count=v[-2], seconds=round(v[-1], 3),
+                                     average=round(v[-1] / v[-2], 4) if v[-2] > 0 else 0.0,
+                                     p50=percentile(v, 0.5), p90=percentile(v, 0.9), p99=percentile(v, 0.99),
+                                     buckets=dict(zip([str(b) for b in latency_buckets] + ['inf'],
+                                                      v[:len(latency_buckets) + 1]))))
+                         for host, v in latencies.items()),
+            download=dict(bytes=transferred, seconds=round(download, 3),
+                          bytes_per_second=round(transferred / download, 1) if download > 0 else 0.0))
+
+
+def save_summary(fn):
+    with open(fn, 'w', encoding='utf-8') as f:
+        json.dump(summary(), f, indent=2)
+    return fn
+
+
+def prometheus_text():
+    lines = []
+    with lock:
+        lines.append('# TYPE bilibili_phase_seconds_total counter')
+        for name, v in phases.items():
+            lines.append('bilibili_phase_seconds_total{{phase="{}"}} {:.6f}'.format(name, v[1]))
+        lines.append('# TYPE bilibili_phase_wall_seconds gauge')
+        for name, v in phases.items():
+            lines.append('bilibili_phase_wall_seconds{{phase="{}"}} {:.6f}'.format(name, v[3] - v[2]))
+        lines.append('# TYPE bilibili_events_total counter')
+        for name, v in counters.items():
+            lines.append('bilibili_events_total{{event="{}"}} {}'.format(name, v))
+        lines.append('# TYPE bilibili_request_seconds histogram')
+        for host, v in latencies.items():
+            seen = 0
+            for i, bound in enumerate(latency_buckets):
+                seen += v[i]
+                lines.append('bilibili_request_seconds_bucket{{host="{}",le="{}"}} {}'.format(host, bound, seen))
+            lines.append('bilibili_request_seconds_bucket{{host="{}",le="+Inf"}} {}'.format(host, v[-2]))
+            lines.append('bilibili_request_seconds_sum{{host="{}"}} {:.6f}'.format(host, v[-1]))
+            lines.append('bilibili_request_seconds_count{{host="{}"}} {}'.format(host, v[-2]))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    # written aside and renamed, the node exporter never reads a half written file
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(prometheus_text())
+    os.replace(path + '.tmp', path)
+
+
+class TextfileExporter(threading.Thread):
+    def __init__(self, path, interval=10.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                write_textfile(self.path)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        write_textfile(self.path)
+
+
+def start_exporter(path, interval=10.0):
+    global exporter
+    exporter = TextfileExporter(path, interval)
+    exporter.start()
+    return exporter
+
+
+def stop_exporter():
+    global exporter
+    if exporter is not None:
+        exporter.stop()
+        exporter = None
@@ -1,15 +1,145 @@
+import os
 import re
+import sys
+import json
+import queue
+import atexit
+import ssl
+import zlib
+import random
 import socket
 import time
 import math
+import base64
+import shutil
 import datetime
+import threading
+import collections
+import http.client
 import logging
 import logging.handlers
-from urllib import request, error
+from urllib import parse, request
+
+import metrics
 
 all_loggers = {}
 
 
+log_queue = queue.SimpleQueue()
+log_listener = None
+logging._srcfile = None  # no stack walk per record, funcName and lineno are not logged
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per line
+    def format(self, record):
+        entry = dict(time=self.formatTime(record), name=record.name, level=record.levelname,
+                     process=record.process, thread=record.threadName, message=record.getMessage())
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+log_formats = dict(text=logging.Formatter('%(asctime)s %(name)s [%(process)d]:[%(levelname)s] %(message)s'),
+                   json=JsonFormatter())
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # the logging thread only puts the record on the queue, the writer thread formats it
+    def prepare(self, record):
+        return record
+
+
+class LogRateLimit(logging.Filter):
+    # at most rate debug records a second, burst at once, of one message template. a template is the message
+    # of a record with arguments, a record formatted by the caller is always let through
+    def __init__(self, rate=10.0, burst=20.0):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}  # (name, template) -> [tokens, last time]
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not record.args:
+            return True
+        now = time.monotonic()
+        key = (record.name, record.msg)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+        metrics.count('log_dropped')
+        return False
+
+
+class LogFiles(logging.Handler):
+    # writes a record to <name>_log.log of its logger, run by the writer thread only
+    def __init__(self):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.files = {}
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        for handler in self.files.values():
+            handler.setFormatter(fmt)
+
+    def emit(self, record):
+        handler = self.files.get(record.name)
+        if handler is None:
+            handler = logging.handlers.TimedRotatingFileHandler("{}_log.log".format(record.name), when='D', interval=1,
+                                                                backupCount=0, encoding='utf-8', delay=True)
+            handler.suffix = '%Y-%m-%d_%H-%M-%S.log'
+            handler.setFormatter(self.formatter)
+            self.files[record.name] = handler
+        handler.handle(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        logging.Handler.close(self)
+
+
+log_files = LogFiles()  # log everything in the files
+log_files.setFormatter(log_formats['text'])
+log_stream = logging.StreamHandler()
+log_stream.setLevel(logging.INFO)  # only display info, warning, error and critical on screen
+log_stream.setFormatter(log_formats['text'])
+log_handler = LogQueueHandler(log_queue)
+log_rate_limit = LogRateLimit()
+log_handler.addFilter(log_rate_limit)
+
+
+def start_logging():
+    # one writer thread per process formats and writes the records of every logger
+    global log_listener
+    if log_listener is None:
+        log_listener = logging.handlers.QueueListener(log_queue, log_files, log_stream, respect_handler_level=True)
+        log_listener.start()
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    # writes what is still queued
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+        log_files.flush()
+
+
+def set_log_format(name='text', debug_rate=None):
+    # name is text or json, for the files. debug_rate limits the repeated debug records per second
+    log_files.setFormatter(log_formats[name])
+    if debug_rate is not None:
+        log_rate_limit.rate = debug_rate
+
+
 def log(name=None):
     if name is None:
         name = 'not_specified'
@@ -17,21 +147,10 @@ def log(name=None):
         g = all_loggers[name]
         return g
     else:
-        fmt = logging.Formatter(
-            '%(asctime)s %(name)s [%(process)d][%(filename)s]:'
-            '[%(levelname)s][%(module)s][%(funcName)s][line:%(lineno)d] %(message)s')
+        start_logging()
         g = logging.getLogger(name)
-        rh = logging.handlers.TimedRotatingFileHandler("{}_log.log".format(name)
-                                                       , when='D', interval=1, backupCount=0, encoding='utf-8')
-        sh = logging.StreamHandler()
         g.setLevel(logging.DEBUG)  # log everything if a handler want to
-        sh.setLevel(logging.INFO)  # only display warning, error and critical on screen
-        rh.setLevel(logging.DEBUG)  # log everything in the file
-        rh.suffix = '%Y-%m-%d_%H-%M-%S.log'
-        rh.setFormatter(fmt)
-        sh.setFormatter(fmt)
-        g.addHandler(sh)
-        g.addHandler(rh)
+        g.addHandler(log_handler)
         all_loggers[name] = g
         return g
 
@@ -49,17 +168,152 @@ def validated_file_name(title):
     return new_title
 
 
-def progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█'):
-    percent = 0.0
-    filled_length = 0
-    if total > 0:
-        percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-        filled_length = int(length * iteration // total)
-    bar = fill * filled_length + '-' * (length - filled_length)
-    print('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix), end='\r')
-    # Print New Line on Complete
-    if iteration == total:
-        print()
+class ProgressReporter:
+    # the progress of the running stages and downloads, updated by cheap calls and rendered by one background
+    # thread at most rate times per second. a tty gets the totals and a line per active download rewritten in
+    # place, or all of it on one line where the terminal has no ansi cursor moves. anything else gets a plain
+    # line of the totals every interval seconds when something changed
+    def __init__(self, rate=4.0, interval=10.0, length=30):
+        self.rate = rate
+        self.interval = interval
+        self.length = length
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()  # name -> [done, total]
+        self.transfers = {}  # key -> [bytes done, length], written by the thread of the download only
+        self.finished = 0  # bytes of the ended transfers
+        self.files = 0  # ended transfers
+        self.samples = collections.deque()  # (time, bytes) of the last seconds, for the throughput
+        self.thread = None
+        self.stopped = threading.Event()
+        self.tty = False
+        self.ansi = False
+        self.last = None
+        self.started = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.tty = sys.stdout.isatty()
+            self.ansi = self.tty and (sys.platform != 'win32' or 'WT_SESSION' in os.environ)
+            self.started = time.monotonic()
+            self.finished, self.files = 0, 0
+            self.samples.clear()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return
+        self.stopped.set()
+        thread.join()
+        self.render(final=True)
+        with self.lock:
+            self.stages.clear()
+            self.last = None
+
+    def run(self):
+        wait = 1.0 / self.rate if self.tty else self.interval
+        while not self.stopped.wait(wait):
+            self.render()
+
+    def stage(self, name, done, total):
+        with self.lock:
+            self.stages[name] = [done, total]
+
+    def end_stage(self, name):
+        with self.lock:
+            self.stages.pop(name, None)
+
+    def begin(self, key, length, done=0):
+        with self.lock:
+            self.transfers[key] = [done, length, os.path.basename(key)]
+
+    def advance(self, key, size):
+        self.transfers[key][0] += size
+
+    def end(self, key):
+        with self.lock:
+            transfer = self.transfers.pop(key, None)
+            if transfer is not None:
+                self.finished += transfer[0]
+                self.files += 1
+
+    def text(self, final=False):
+        with self.lock:
+            stages = list(self.stages.items())
+            transfers = [transfer[:2] for transfer in self.transfers.values()]
+            transferred = self.finished + sum(transfer[0] for transfer in transfers)
+            files = self.files
+        now = time.monotonic()
+        self.samples.append((now, transferred))
+        while now - self.samples[0][0] > 5:
+            self.samples.popleft()
+        first = self.samples[0] if not final else (self.started, 0)  # the average of the run at last
+        speed = (transferred - first[1]) / (now - first[0]) if now > first[0] else 0.0
+        parts = []
+        for i, (name, (done, total)) in enumerate(stages):
+            percent = 100.0 * done / total if total > 0 else 0.0
+            if i == 0 and self.tty:
+                filled = int(self.length * done // total) if total > 0 else 0
+                bar = '█' * filled + '-' * (self.length - filled)
+                parts.append('|{}| {:.1f}% {} {}/{}'.format(bar, percent, name, done, total))
+            else:
+                parts.append('{} {}/{} {:.1f}%'.format(name, done, total, percent))
+        if len(transfers) > 0 or files > 0:
+            parts.append('{} downloading, {} done, {:.1f} MB, {:.2f} MB/s'.format(len(transfers), files,
+                                                                                transferred / 1024 / 1024,
+                                                                                speed / 1024 / 1024))
+        return 'Progress: ' + ' | '.join(parts) if len(parts) > 0 else ''
+
+    def active(self, rows):
+        # name and percent of the running downloads, rows at most
+        with self.lock:
+            transfers = list(self.transfers.values())
+        active = ['{} {:.1f}%'.format(name, 100.0 * done / length if length else 0.0)
+                  for done, length, name in transfers[:rows]]
+        if len(transfers) > rows > 0:
+            active[-1] = '... {} more'.format(len(transfers) - rows + 1)
+        return active
+
+    def render(self, final=False):
+        text = self.text(final)
+        if len(text) == 0:
+            return
+        if not self.tty:
+            if text != self.last:
+                self.last = text
+                sys.stdout.write(text + '\n')
+                sys.stdout.flush()
+            return
+        size = shutil.get_terminal_size()
+        width = size.columns - 1
+        active = [] if final else self.active(max(size.lines - 2, 1))
+        if self.ansi:
+            lines = [text] + ['  ' + line for line in active]
+        else:
+            lines = [' | '.join([text] + active)]
+        if lines == self.last:
+            return
+        self.last = lines
+        # drawn from the start of the line of the cursor down, the cursor goes back there for the next render
+        output = '\r' + '\n'.join(line[:width].ljust(width) for line in lines)
+        if self.ansi:
+            output += '\x1b[J'
+        if final:
+            output += '\n'
+        elif len(lines) > 1:
+            output += '\x1b[{}F'.format(len(lines) - 1)
+        else:
+            output += '\r'
+        sys.stdout.write(output)
+        sys.stdout.flush()
+
+
+reporter = ProgressReporter()
 
 
 def get_generic_request_headers():
@@ -71,33 +325,475 @@ def get_generic_request_headers():
     return headers
 
 
-def request_url(url, headers=None, timeout=60):
-    logger.debug('requesting {}'.format(url))
+class ConnectionPool:
+    # keeps up to size idle keep-alive connections of one scheme://host:port, through a proxy when one is given
+    def __init__(self, scheme, host, port, size, proxy=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = size
+        self.proxy = proxy
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout, fresh=False):
+        with self.lock:
+            conn = self.idle.pop() if len(self.idle) > 0 and not fresh else None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        if self.proxy is not None:
+            proxy_host, proxy_port, auth = self.proxy
+            if self.scheme == 'https':  # a CONNECT tunnel through the proxy, tls with the host itself
+                conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=timeout, context=ssl_context)
+                conn.set_tunnel(self.host, self.port, headers=None if auth is None else {'Proxy-Authorization': auth})
+            else:
+                conn = http.client.HTTPConnection(proxy_host, proxy_port, timeout=timeout)
+        elif self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=timeout, context=ssl_context)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        return conn, False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            while len(self.idle) > 0:
+                self.idle.pop().close()
+
+
+class PooledResponse:
+    # the connection goes back to its pool as soon as the body is fully read,
+    # a response closed before the end drops its connection instead
+    def __init__(self, pool, conn, res, url, decode=True):
+        self.pool = pool
+        self.conn = conn
+        self.res = res
+        self.url = url
+        self.status = res.status
+        self.reason = res.reason
+        self.headers = res.headers
+        self.decoder = None
+        self.buffer = b''
+        self.closed = False
+        encoding = (res.getheader('Content-Encoding') or '').strip().lower()
+        if decode and encoding in ['gzip', 'x-gzip', 'deflate']:
+            self.decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)  # gzip or zlib header
+
+    def getheader(self, name, default=None):
+        return self.res.getheader(name, default)
+
+    def read(self, amt=None):
+        if self.closed:
+            return b''
+        if self.decoder is None:
+            data = self.res.read() if amt is None else self.res.read(amt)
+            if amt is None or not data:
+                self.close()
+            return data
+        if amt is None:
+            data = self.buffer + self.decoder.decompress(self.res.read()) + self.decoder.flush()
+            self.buffer = b''
+            self.close()
+            return data
+        while len(self.buffer) < amt:
+            raw = self.res.read(amt)
+            if not raw:
+                self.buffer += self.decoder.flush()
+                self.close()
+                break
+            self.buffer += self.decoder.decompress(raw)
+        data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+    def readinto(self, b):
+        # reads into the buffer b without a bytes object per read, returns the size read, 0 at the end
+        if self.closed:
+            return 0
+        if self.decoder is not None:
+            data = self.read(len(b))
+            b[:len(data)] = data
+            return len(data)
+        size = self.res.readinto(b)
+        if not size:
+            self.close()
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.res.isclosed():  # body fully read, the connection is ready for the next request
+            self.pool.release(self.conn)
+        else:
+            self.res.close()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_proxies():
+    # scheme -> (host, port, Proxy-Authorization or None) of the *_proxy environment variables, as urlopen used them
+    proxies = {}
+    for scheme, url in request.getproxies().items():
+        if scheme not in ['http', 'https']:
+            continue
+        parts = parse.urlsplit(url if '://' in url else 'http://' + url)
+        if parts.hostname is None:
+            continue
+        auth = None
+        if parts.username is not None:
+            credentials = '{}:{}'.format(parse.unquote(parts.username), parse.unquote(parts.password or ''))
+            auth = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        proxies[scheme] = (parts.hostname, parts.port or 80, auth)
+    return proxies
+
+
+proxies = read_proxies()
+proxy_bypassed = {}  # host -> the host is excluded from the proxies by no_proxy
+
+
+def get_proxy(scheme, host):
+    proxy = proxies.get(scheme)
+    if proxy is None:
+        return None
+    if host not in proxy_bypassed:
+        proxy_bypassed[host] = bool(request.proxy_bypass(host))
+    return None if proxy_bypassed[host] else proxy
+
+
+class HttpSession:
+    # per host pools of keep-alive connections shared by every request of the application
+    def __init__(self, pool_size=10, max_redirects=5):
+        self.pool_size = pool_size
+        self.max_redirects = max_redirects
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def configure(self, pool_size):
+        with self.lock:
+            self.pool_size = pool_size
+            for pool in self.pools.values():
+                pool.size = pool_size
+
+    def pool(self, scheme, host, port, proxy=None):
+        key = (scheme, host, port, proxy)
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(scheme, host, port, self.pool_size, proxy)
+            return self.pools[key]
+
+    def request(self, url, headers, timeout=60, decode=True):
+        headers = dict(headers)
+        if decode and not any(k.lower() == 'accept-encoding' for k in headers):
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        for redirect in range(self.max_redirects + 1):
+            parts = parse.urlsplit(url)
+            scheme = parts.scheme.lower()
+            host = parts.hostname
+            port = parts.port or (443 if scheme == 'https' else 80)
+            proxy = None
+            if host in host_overrides:  # e.g. a local mock server of the benchmark
+                scheme, host, port = host_overrides[host]
+            else:
+                proxy = get_proxy(scheme, host)
+            pool = self.pool(scheme, host, port, proxy)
+            path = parts.path or '/'
+            if parts.query:
+                path = '{}?{}'.format(path, parts.query)
+            if proxy is not None and scheme != 'https':  # a plain http proxy is asked for the whole url
+                path = '{}://{}{}'.format(scheme, parts.netloc, path)
+                if proxy[2] is not None:
+                    headers['Proxy-Authorization'] = proxy[2]
+            conn, reused = pool.acquire(timeout)
+            try:
+                try:
+                    conn.request('GET', path, headers=headers)
+                    res = conn.getresponse()
+                except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError) as e:
+                    if not reused:
+                        raise
+                    # the server dropped the idle keep-alive connection, try once more on a new one
+                    logger.debug('stale connection to %s, reconnecting. %s', parts.hostname, e)
+                    conn.close()
+                    conn, reused = pool.acquire(timeout, fresh=True)
+                    conn.request('GET', path, headers=headers)
+                    res = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+            response = PooledResponse(pool, conn, res, url, decode)
+            location = res.getheader('Location')
+            if res.status in [301, 302, 303, 307, 308] and location and redirect < self.max_redirects:
+                response.read()
+                response.close()
+                url = parse.urljoin(url, location)
+                headers.pop('Host', None)
+                logger.debug('redirected to %s', url)
+                continue
+            return response
+
+
+class HostLimiter:
+    # token bucket for the request rate of one host, plus a concurrency limit. both are
+    # adjusted by AIMD: cut by half on 412/429, by a fifth on errors, raised a little by every success
+    def __init__(self, host, rate=10.0, concurrency=8, min_rate=0.5, max_rate=100.0, max_concurrency=64):
+        self.host = host
+        self.rate = float(rate)
+        self.limit = float(concurrency)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.tokens = 1.0
+        self.active = 0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.cooldown = 1.0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.active < int(self.limit) and self.tokens >= 1 and now >= self.blocked_until:
+                    self.tokens -= 1
+                    self.active += 1
+                    self.requests += 1
+                    return
+                if self.active >= int(self.limit):
+                    self.cond.wait()  # woken up by release
+                else:
+                    self.cond.wait(max((1 - self.tokens) / self.rate, self.blocked_until - now, 0.001))
+
+    def release(self, status):
+        # status is the http status, or None when the request failed without one
+        with self.cond:
+            self.active -= 1
+            if status in [412, 429]:
+                self.throttled += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.limit = max(1.0, self.limit / 2)
+                self.blocked_until = time.monotonic() + self.cooldown
+                self.cooldown = min(60.0, self.cooldown * 2)
+                logger.warning('{} is throttling ({}), slow down to {:.1f} request/s, {} connection(s)'
+                               .format(self.host, status, self.rate, int(self.limit)))
+            elif status is None or status >= 500:
+                self.errors += 1
+                self.rate = max(self.min_rate, self.rate * 0.8)
+                self.limit = max(1.0, self.limit * 0.8)
+            else:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self.cooldown = max(1.0, self.cooldown / 2)
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return dict(rate=round(self.rate, 2), concurrency=int(self.limit), active=self.active,
+                        requests=self.requests, errors=self.errors, throttled=self.throttled)
+
+
+ssl_context = ssl.create_default_context()
+session = HttpSession()
+host_overrides = {}  # host -> (scheme, host, port) the requests of the host are sent to
+limited_hosts = ['space.bilibili.com', 'www.bilibili.com', 'www.kanbilibili.com', 'kanbilibili.com']
+limiters = {}  # host -> HostLimiter of the limited hosts
+limiters_lock = threading.Lock()
+limiter_defaults = dict(rate=10.0, concurrency=8, max_rate=100.0)
+
+
+def configure_session(pool_size):
+    session.configure(pool_size)
+
+
+def set_host_override(host, address=None):
+    # sends the requests of host to address (e.g. http://127.0.0.1:8000) instead, None removes it
+    if address is None:
+        host_overrides.pop(host, None)
+    else:
+        parts = parse.urlsplit(address)
+        scheme = parts.scheme.lower()
+        host_overrides[host] = (scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+
+
+def set_rate_limit(rate=None, concurrency=None, host=None, share=1):
+    # initial limits of every limited host, or of the given host only. the rate and the rate it may adapt up to
+    # are split between share processes sending from the same address
+    with limiters_lock:
+        hosts = limited_hosts if host is None else [host]
+        if host is None:
+            if rate is not None:
+                limiter_defaults['rate'] = float(rate) / share
+            if concurrency is not None:
+                limiter_defaults['concurrency'] = concurrency
+            limiter_defaults['max_rate'] = 100.0 / share
+        for name in hosts:
+            if name not in limiters:
+                limiters[name] = HostLimiter(name, **limiter_defaults)
+            if rate is not None:
+                limiters[name].rate = float(rate) / share
+            limiters[name].max_rate = 100.0 / share
+            if concurrency is not None:
+                limiters[name].limit = float(concurrency)
+            if host is not None and name not in limited_hosts:
+                limited_hosts.append(name)
+
+
+def get_limiter(host):
+    if host not in limited_hosts:
+        return None
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = HostLimiter(host, **limiter_defaults)
+        return limiters[host]
+
+
+def get_rate_limits():
+    # current limits and counters of every limited host used so far
+    with limiters_lock:
+        return dict((host, limiter.stats()) for host, limiter in limiters.items())
+
+
+def request_url(url, headers=None, timeout=60, decode=True):
+    logger.debug('requesting %s', url)
+    host = parse.urlsplit(url).hostname
+    limiter = get_limiter(host)
+    if limiter is not None:
+        began = time.perf_counter()
+        limiter.acquire()
+        metrics.count('rate_limit_seconds', time.perf_counter() - began)
+    status = None
     try:
         if headers is None:
             headers = get_generic_request_headers()
-        req = request.Request(url, headers=headers)
-        res = request.urlopen(req, timeout=timeout)
+        began = time.perf_counter()
+        res = session.request(url, headers, timeout, decode)
+        metrics.observe(host, time.perf_counter() - began)  # until the headers, the body is read by the caller
+        status = res.status
+        if res.status >= 400:
+            logger.error('error: url {} {} {}'.format(res.status, res.reason, url))
+            res.close()
+            return None
         return res
-    except error.URLError as e:
-        logger.error('error: url {} '.format(e.reason))
-        return None
     except socket.timeout as e:
         logger.error('error: timeout {}'.format(e))
         return None
+    except (OSError, http.client.HTTPException) as e:
+        logger.error('error: url {} {}'.format(e, url))
+        return None
     except Exception as e:
         logger.error('error: unknown {}'.format(e))
         return None
+    finally:
+        if status is None or status >= 400:
+            metrics.count('request_failures')
+        if limiter is not None:
+            limiter.release(status)
 
 
-def has_keywords(text, words):
-    if words is None or len(words) == 0:
-        return True
-    else:
-        for word in words:
-            if word in text:
+def backoff(attempt, base=0.5, cap=30.0):
+    # exponential backoff with full jitter, attempt starts from 0
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def ordered_map(executor, fn, items, window=8):
+    # fn(item) run on the executor, the results are yielded in the order of items. at most window
+    # calls are ahead of the consumer, so a long stream of items is never held in memory at once
+    futures = collections.deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(fn, item))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:  # the consumer stopped early
+            future.cancel()
+
+
+class KeywordMatcher:
+    # Aho-Corasick automaton of the keywords, a text is matched in one pass over its characters
+    # with the same result as testing "word in text" for every word
+    def __init__(self, words=None):
+        self.words = list(dict.fromkeys(words or []))
+        self.everything = len(self.words) == 0 or '' in self.words  # no keywords do not filter anything
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [False]
+        for word in self.words:
+            state = 0
+            for ch in word:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(False)
+                    self.goto[state][ch] = nxt
+                state = nxt
+            self.out[state] = True
+        queue = collections.deque(self.goto[0].values())
+        while len(queue) > 0:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                failed = self.fail[state]
+                while failed and ch not in self.goto[failed]:
+                    failed = self.fail[failed]
+                self.fail[nxt] = self.goto[failed].get(ch, 0)
+                self.out[nxt] = self.out[nxt] or self.out[self.fail[nxt]]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __repr__(self):
+        return repr(self.words)
+
+    def search(self, text):
+        if self.everything:
+            return True
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
                 return True
-    return False
+        return False
+
+    def filter(self, items, key=None):
+        # the items (or key(item)) having any keyword, e.g. a page of topics or the rows of a csv
+        if self.everything:
+            return list(items)
+        search = self.search
+        if key is None:
+            return [item for item in items if search(item)]
+        return [item for item in items if search(key(item))]
+
+
+def compile_keywords(words):
+    if isinstance(words, KeywordMatcher):
+        return words
+    return KeywordMatcher(words)
 
 
 def timestamp():
@@ -0,0 +1,125 @@
+import re
+import time
+import random
+import sqlite3
+import threading
+
+import utility
+
+logger = utility.log('watch')
+
+
+def read_channels(fn):
+    # the mids of a channel list, one url or mid per line, # starts a comment
+    mids = []
+    with open(fn, 'r', encoding='utf_8_sig') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if len(line) == 0:
+                continue
+            match = re.search(r'space\.bilibili\.com/([0-9]+)', line) or re.fullmatch(r'[0-9]+', line)
+            if match is None:
+                logger.warning('{} is neither a bilibili url nor a mid'.format(line))
+                continue
+            mids.append(match.group(1) if match.groups() else match.group(0))
+    return mids
+
+
+class WatchSchedule:
+    # when to poll every watched channel, kept on disk across the runs of the daemon. a channel is polled
+    # about polls_per_upload times per its estimated gap between two uploads, never more often than
+    # min_interval and at least every max_interval, give or take jitter, so the polls follow the uploads
+    # instead of the number of channels
+    def __init__(self, path='watch.db', min_interval=300.0, max_interval=86400.0, jitter=0.2, polls_per_upload=4,
+                 smoothing=0.3):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.polls_per_upload = polls_per_upload
+        self.smoothing = smoothing  # weight of the latest observed gap in the estimate
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS channels (mid TEXT PRIMARY KEY, count INTEGER, gap REAL, '
+                        'changed REAL, next REAL NOT NULL, polls INTEGER NOT NULL DEFAULT 0, '
+                        'crawls INTEGER NOT NULL DEFAULT 0)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS channels_next ON channels (next)')
+        self.db.commit()
+        logger.debug('watch schedule {} opened'.format(path))
+
+    def interval(self, gap):
+        # an unknown gap starts at min_interval, and grows with the time the channel stays quiet
+        interval = self.min_interval if gap is None else gap / self.polls_per_upload
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def sync(self, mids):
+        # watches the mids of the list only, the new ones are polled within min_interval, spread over it
+        now = time.time()
+        with self.lock:
+            known = set(mid for mid, in self.db.execute('SELECT mid FROM channels').fetchall())
+            added = [mid for mid in dict.fromkeys(mids) if mid not in known]
+            removed = known - set(mids)
+            self.db.executemany('INSERT INTO channels (mid, next) VALUES (?, ?)',
+                                [(mid, now + random.uniform(0, self.min_interval)) for mid in added])
+            self.db.executemany('DELETE FROM channels WHERE mid = ?', [(mid,) for mid in removed])
+            self.db.commit()
+        return len(added), len(removed)
+
+    def due(self, now, limit):
+        with self.lock:
+            return [mid for mid, in self.db.execute('SELECT mid FROM channels WHERE next <= ? ORDER BY next LIMIT ?',
+                                                    (now, limit)).fetchall()]
+
+    def next_poll(self):
+        # when the next channel is due, None when nothing is watched
+        with self.lock:
+            return self.db.execute('SELECT MIN(next) FROM channels').fetchone()[0]
+
+    def has_new(self, mid, count):
+        # page 1 of the channel tells count uploads, are some of them not crawled yet
+        with self.lock:
+            row = self.db.execute('SELECT count FROM channels WHERE mid = ?', (mid,)).fetchone()
+        return row is None or row[0] is None or count > row[0]
+
+    def update(self, mid, count, created=(), crawled=False):
+        # the channel was polled and crawled when it had to be. created are the upload times of page 1, they
+        # give the first estimate of the gap between two uploads
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT count, gap, changed FROM channels WHERE mid = ?', (mid,)).fetchone()
+            if row is None:
+                return
+            last, gap, changed = row
+            if last is None:
+                created = sorted(created)
+                gap = (created[-1] - created[0]) / (len(created) - 1) if len(created) > 1 else None
+                changed = created[-1] if len(created) > 0 else now
+            elif count > last:
+                observed = (now - changed) / (count - last)
+                gap = observed if gap is None else gap * (1 - self.smoothing) + observed * self.smoothing
+                changed = now
+            elif gap is None or now - changed > gap:
+                gap = now - changed  # quiet for longer than expected
+            self.db.execute('UPDATE channels SET count = ?, gap = ?, changed = ?, next = ?, polls = polls + 1, '
+                            'crawls = crawls + ? WHERE mid = ?',
+                            (count, gap, changed, now + self.interval(gap), 1 if crawled else 0, mid))
+            self.db.commit()
+
+    def failed(self, mid):
+        # polled or crawled in vain, tried again after min_interval with the count it had
+        with self.lock:
+            self.db.execute('UPDATE channels SET next = ?, polls = polls + 1 WHERE mid = ?',
+                            (time.time() + self.interval(0), mid))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            channels, polls, crawls, gap = self.db.execute('SELECT COUNT(*), SUM(polls), SUM(crawls), AVG(gap) '
+                                                           'FROM channels').fetchone()
+        return dict(channels=channels, polls=polls or 0, crawls=crawls or 0, gap=gap)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
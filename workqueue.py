@@ -0,0 +1,160 @@
+import json
+import time
+import sqlite3
+import threading
+import contextlib
+
+import utility
+from jobs import Status
+
+logger = utility.log('workqueue')
+
+
+class WorkQueue:
+    # units of work shared by the processes of a run through one sqlite file. a worker leases a unit for
+    # ttl seconds and renews the lease by heartbeats, the unit of a worker that died is leased again once
+    # its lease expired, up to max_attempts times
+    def __init__(self, path='queue.db', ttl=60.0, max_attempts=3):
+        self.path = path
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()  # one connection per process, shared by its threads
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS units (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, '
+                        'key TEXT NOT NULL, grp TEXT, seq INTEGER, priority INTEGER NOT NULL DEFAULT 0, '
+                        'payload TEXT, status INTEGER NOT NULL DEFAULT 0, owner TEXT, expires REAL, '
+                        'attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT, UNIQUE (kind, key))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS units_lease ON units (status, priority, id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS units_grp ON units (grp, kind, status)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        logger.debug('work queue {} opened'.format(path))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def set(self, name, value):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, json.dumps(value)))
+
+    def get(self, name, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def clear(self):
+        with self.transaction() as db:
+            db.execute('DELETE FROM units')
+            db.execute('DELETE FROM meta')
+
+    @staticmethod
+    def insert(db, units):
+        # units are dict(kind, key, grp, seq, priority, payload), a unit already queued is kept as it is
+        db.executemany('INSERT OR IGNORE INTO units (kind, key, grp, seq, priority, payload) VALUES (?, ?, ?, ?, ?, ?)',
+                       [(unit['kind'], str(unit['key']), unit.get('grp'), unit.get('seq'), unit.get('priority', 0),
+                         json.dumps(unit.get('payload'))) for unit in units])
+
+    def put(self, units):
+        with self.transaction() as db:
+            self.insert(db, units)
+
+    def lease(self, owner, kinds, limit=1):
+        # up to limit waiting (or expired) units of the kinds, the lowest priority first
+        now = time.time()
+        marks = ', '.join('?' * len(kinds))
+        with self.transaction() as db:
+            rows = db.execute('SELECT id, kind, key, grp, payload, attempts, status FROM units WHERE kind IN ({}) '
+                              'AND (status = ? OR (status = ? AND expires < ?)) ORDER BY priority, id '
+                              'LIMIT ?'.format(marks),
+                              list(kinds) + [int(Status.WAITING), int(Status.DOING), now, limit]).fetchall()
+            units = []
+            for uid, kind, key, grp, payload, attempts, status in rows:
+                if attempts >= self.max_attempts:
+                    db.execute('UPDATE units SET status = ?, owner = NULL, error = ? WHERE id = ?',
+                               (int(Status.FAILED), 'lease expired {} times'.format(attempts), uid))
+                    continue
+                if status == Status.DOING:
+                    logger.warning('lease of {} {} expired, leased again by {}'.format(kind, key, owner))
+                db.execute('UPDATE units SET status = ?, owner = ?, expires = ?, attempts = attempts + 1 WHERE id = ?',
+                           (int(Status.DOING), owner, now + self.ttl, uid))
+                units.append(dict(id=uid, kind=kind, key=key, grp=grp, payload=json.loads(payload)))
+        return units
+
+    def heartbeat(self, owner, ids):
+        if len(ids) == 0:
+            return
+        with self.transaction() as db:
+            db.executemany('UPDATE units SET expires = ? WHERE id = ? AND owner = ? AND status = ?',
+                           [(time.time() + self.ttl, uid, owner, int(Status.DOING)) for uid in ids])
+
+    def complete(self, unit, owner, result, children=()):
+        # the result and the units found by it are saved in one transaction
+        with self.transaction() as db:
+            self.insert(db, children)
+            db.execute('UPDATE units SET status = ?, result = ?, owner = NULL WHERE id = ? AND owner = ?',
+                       (int(Status.COMPLETED), json.dumps(result), unit['id'], owner))
+
+    def fail(self, unit, owner, error):
+        # waits for another attempt, unless it had all of them
+        with self.transaction() as db:
+            db.execute('UPDATE units SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, owner = NULL, error = ? '
+                       'WHERE id = ? AND owner = ?', (self.max_attempts, int(Status.WAITING), int(Status.FAILED),
+                                                      str(error), unit['id'], owner))
+
+    def unfinished(self, grp=None, kinds=None):
+        sql = 'SELECT COUNT(*) FROM units WHERE status IN (?, ?)'
+        parameters = [int(Status.WAITING), int(Status.DOING)]
+        if grp is not None:
+            sql += ' AND grp = ?'
+            parameters.append(grp)
+        if kinds is not None:
+            sql += ' AND kind IN ({})'.format(', '.join('?' * len(kinds)))
+            parameters.extend(kinds)
+        with self.lock:
+            return self.db.execute(sql, parameters).fetchone()[0]
+
+    def results(self, kind, grp=None):
+        # (key, status, result) of the units of a kind, of one group only when grp is given, in seq order
+        sql = 'SELECT key, status, result FROM units WHERE kind = ?'
+        parameters = [kind]
+        if grp is not None:
+            sql += ' AND grp = ?'
+            parameters.append(grp)
+        with self.lock:
+            rows = self.db.execute(sql + ' ORDER BY grp, seq, id', parameters).fetchall()
+        return [(key, status, None if result is None else json.loads(result)) for key, status, result in rows]
+
+    def take_finished(self, kind):
+        # (key, status, result) of the completed and failed units of a kind, deleted from the queue
+        finished = [int(Status.COMPLETED), int(Status.FAILED)]
+        with self.transaction() as db:
+            rows = db.execute('SELECT key, status, result FROM units WHERE kind = ? AND status IN (?, ?) ORDER BY id',
+                              [kind] + finished).fetchall()
+            db.execute('DELETE FROM units WHERE kind = ? AND status IN (?, ?)', [kind] + finished)
+        return [(key, status, None if result is None else json.loads(result)) for key, status, result in rows]
+
+    def counts(self, kind=None, grp=None):
+        sql = 'SELECT status, COUNT(*) FROM units WHERE 1 = 1'
+        parameters = []
+        if kind is not None:
+            sql += ' AND kind = ?'
+            parameters.append(kind)
+        if grp is not None:
+            sql += ' AND grp = ?'
+            parameters.append(grp)
+        with self.lock:
+            counts = dict(self.db.execute(sql + ' GROUP BY status', parameters).fetchall())
+        return dict((status.name.lower(), counts.get(status, 0)) for status in Status)
+
+    def close(self):
+        with self.lock:
+            self.db.close()